@@ -1,207 +1,1468 @@
+import time
+_module_started = time.perf_counter()
+
 import uuid
-from flask import Flask, json, request, jsonify, render_template, send_from_directory, session, make_response
+import atexit
+import copy
+import contextvars
+import inspect
+import logging
+import logging.handlers
+import json as stdlib_json
+from flask import Blueprint, Flask, Response, current_app, json, request, jsonify, render_template, send_from_directory, session, stream_with_context
 from flask_cors import CORS
-import openai
 import os
-import psycopg2
+import sys
 import requests
-from bs4 import BeautifulSoup
-import spacy
+import requests.adapters
+import urllib3
 import sqlite3
+import fcntl
+from html.parser import HTMLParser
+import hashlib
+import unicodedata
+import threading
+import queue
+import bisect
+import random
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import OrderedDict
+from functools import lru_cache, wraps
 from datetime import datetime, timedelta, timezone
 
-# Configuración inicial
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
-CORS(app, resources={r"/*": {"origins": "*"}})
-app.config['DEBUG'] = True
+# spaCy, openai, psycopg2 y numpy se importan recién cuando se usan (ver
+# get_nlp, get_openai y get_db_pool), así el proceso puede responder /healthz
+# antes de cargar el modelo.
+
+# Logging estructurado. Los registros se encolan sin bloquear y un hilo por
+# proceso los escribe en stdout, así las rutas no esperan la E/S; un DEBUG
+# desactivado no llega a formatear el mensaje.
+#   LOG_LEVEL               DEBUG, INFO (por defecto), WARNING, ERROR
+#   LOG_FORMAT              json (una línea por registro, por defecto) o text
+#   LOG_DEBUG_SAMPLE_RATE   fracción de los DEBUG que se escriben (0 a 1)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+logger = logging.getLogger('chatbot')
+
+# ID de la solicitud en curso (X-Request-ID); se agrega a cada registro
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and LOG_DEBUG_SAMPLE_RATE < 1 and random.random() >= LOG_DEBUG_SAMPLE_RATE:
+            return False
+        record.request_id = request_id_var.get() or '-'
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'request_id': getattr(record, 'request_id', '-'),
+            'msg': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+    # QueueHandler con una cola y un QueueListener por proceso (los hilos no
+    # sobreviven al fork de gunicorn). Si la cola se llena el registro se
+    # descarta en lugar de frenar la solicitud.
+    def __init__(self, target, queue_size):
+        super().__init__(None)
+        self.target = target
+        self.queue_size = queue_size
+        self.listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue(maxsize=self.queue_size)
+                self.listener = logging.handlers.QueueListener(self.queue, self.target)
+                self.listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Resolver el mensaje y la traza en el hilo que loguea; el formato
+        # final (JSON o texto) lo aplica el listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush_and_stop(self):
+        if self._pid == os.getpid() and self.listener is not None:
+            self.listener.stop()
+            self._pid = None
+
+    def snapshot(self):
+        return {
+            'level': logging.getLevelName(logger.getEffectiveLevel()),
+            'format': LOG_FORMAT,
+            'debug_sample_rate': LOG_DEBUG_SAMPLE_RATE,
+            'queued': self.queue.qsize() if self._pid == os.getpid() else 0,
+            'dropped': self.dropped,
+        }
 
-# Cargar el modelo de lenguaje en español
-nlp = spacy.load("es_core_news_md")
+def configure_logging():
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'text':
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s'))
+    else:
+        stream_handler.setFormatter(JsonFormatter())
+    handler = AsyncLogHandler(stream_handler, LOG_QUEUE_SIZE)
+    handler.addFilter(RequestContextFilter())
+    logger.handlers[:] = [handler]
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    # Escribir lo pendiente cuando el proceso termina
+    atexit.register(handler.flush_and_stop)
+    return handler
+
+log_handler = configure_logging()
+
+# Métricas del pipeline: latencia, llamadas y errores por etapa (spaCy,
+# búsqueda, OpenAI, base, WhatsApp) y por ruta, publicadas en formato
+# Prometheus en /metrics. Cada worker de gunicorn tiene las suyas.
+# Con SERVER_TIMING=1 cada respuesta incluye el desglose por etapa en el
+# header Server-Timing.
+SERVER_TIMING = os.getenv('SERVER_TIMING', '0') == '1'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.total += value
+            self.count += 1
+
+    def snapshot(self):
+        # Conteos acumulados por límite superior, como los buckets de Prometheus
+        with self._lock:
+            counts, total, count = list(self.counts), self.total, self.count
+        cumulative, running = {}, 0
+        for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], counts):
+            running += bucket_count
+            cumulative[str(bound)] = running
+        return {'buckets': cumulative, 'sum': round(total, 6), 'count': count}
+
+# Etapas medidas durante la solicitud en curso, para Server-Timing
+request_timings_var = contextvars.ContextVar('request_timings', default=None)
+
+class StageMetrics:
+    def __init__(self):
+        self._stages = {}    # etapa -> (Histogram, {'calls', 'errors'})
+        self._requests = {}  # (ruta, método) -> (Histogram, {estado: cantidad})
+        self._lock = threading.Lock()
+        self._active = threading.local()
+
+    def observe(self, stage, seconds, error=False):
+        entry = self._stages.get(stage)
+        if entry is None:
+            with self._lock:
+                entry = self._stages.setdefault(stage, (Histogram(), {'calls': 0, 'errors': 0}))
+        entry[0].observe(seconds)
+        with self._lock:
+            entry[1]['calls'] += 1
+            if error:
+                entry[1]['errors'] += 1
+        timings = request_timings_var.get()
+        if timings is not None:
+            timings.append((stage, seconds))
+
+    @contextmanager
+    def timed(self, stage):
+        # Las llamadas anidadas a la misma etapa (los helpers que se llaman a
+        # sí mismos con un cursor) se miden una sola vez
+        active = self._active.__dict__.setdefault('stages', set())
+        if stage in active:
+            yield
+            return
+        active.add(stage)
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except BaseException as e:
+            failed = not isinstance(e, GeneratorExit)
+            raise
+        finally:
+            active.discard(stage)
+            self.observe(stage, time.perf_counter() - started, failed)
+
+    def instrument(self, stage):
+        def decorator(func):
+            if inspect.isgeneratorfunction(func):
+                # En los generadores se mide la iteración completa
+                @wraps(func)
+                def generator_wrapper(*args, **kwargs):
+                    with self.timed(stage):
+                        yield from func(*args, **kwargs)
+                return generator_wrapper
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timed(stage):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def observe_request(self, route, method, status, seconds):
+        key = (route, method)
+        entry = self._requests.get(key)
+        if entry is None:
+            with self._lock:
+                entry = self._requests.setdefault(key, (Histogram(), {}))
+        entry[0].observe(seconds)
+        with self._lock:
+            entry[1][status] = entry[1].get(status, 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            stages = {stage: dict(counters) for stage, (_, counters) in self._stages.items()}
+            histograms = {stage: histogram for stage, (histogram, _) in self._stages.items()}
+        for stage, counters in stages.items():
+            histogram = histograms[stage].snapshot()
+            counters['seconds_total'] = histogram['sum']
+            counters['error_rate'] = round(counters['errors'] / counters['calls'], 4) if counters['calls'] else 0.0
+        return stages
+
+    def collect(self):
+        # (etapas, solicitudes) con histogramas completos para /metrics
+        with self._lock:
+            stages = [(stage, histogram, dict(counters)) for stage, (histogram, counters) in self._stages.items()]
+            routes = [(key, histogram, dict(statuses)) for key, (histogram, statuses) in self._requests.items()]
+        return stages, routes
+
+stage_metrics = StageMetrics()
+
+def server_timing_header(timings, total):
+    # Suma por etapa en el orden en que aparecieron
+    durations = OrderedDict()
+    for stage, seconds in timings:
+        durations[stage] = durations.get(stage, 0.0) + seconds
+    entries = [f"{stage.replace('.', '-')};dur={seconds * 1000:.1f}" for stage, seconds in durations.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(entries)
+
+# Perfil de arranque en segundos; se publica en /readyz y con --startup-profile
+STARTUP_PROFILE = OrderedDict()
+
+bp = Blueprint('chatbot', __name__, cli_group=None)
 
 # Configuración de tokens de acceso
-openai.api_key = os.getenv('OPENAI_API_KEY')  # Asegúrate de configurar tu variable de entorno
 ACCESS_TOKEN = os.getenv('ACCESS_TOKEN')
 verify_token = os.getenv('VERIFY_TOKEN')
 PHONE_NUMBER_ID = os.getenv('PHONE_NUMBER_ID')
 WEBHOOK_VERIFY_TOKEN = os.getenv('WEBHOOK_VERIFY_TOKEN')
 WHATSAPP_API_URL= os.getenv('WHATSAPP_API_URL')
 
-@app.route("/")
+# Cargar el modelo de lenguaje en español. Solo usamos lemas y POS
+# (morphologizer + lemmatizer), así que el parser y el NER no se cargan.
+NLP_EXCLUDED_PIPES = ["parser", "ner"]
+NLP_LOAD_SECONDS = None
+NLP_LOADED_IN_PID = None
+_nlp = None
+_nlp_lock = threading.Lock()
+
+def get_nlp():
+    # Con gunicorn --preload (ver gunicorn.conf.py) el modelo se carga una sola
+    # vez en el proceso maestro y los workers lo comparten copy-on-write.
+    global _nlp, NLP_LOAD_SECONDS, NLP_LOADED_IN_PID
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                started = time.perf_counter()
+                import spacy
+                model = spacy.load("es_core_news_md", exclude=NLP_EXCLUDED_PIPES)
+                model("necesito cemento")  # inicializar el pipeline
+                NLP_LOAD_SECONDS = time.perf_counter() - started
+                NLP_LOADED_IN_PID = os.getpid()
+                STARTUP_PROFILE['nlp_load'] = round(NLP_LOAD_SECONDS, 3)
+                _nlp = model
+    return _nlp
+
+_openai = None
+
+def get_openai():
+    global _openai
+    if _openai is None:
+        started = time.perf_counter()
+        import openai
+        openai.api_key = os.getenv('OPENAI_API_KEY')  # Asegúrate de configurar tu variable de entorno
+        STARTUP_PROFILE['openai_import'] = round(time.perf_counter() - started, 3)
+        _openai = openai
+    return _openai
+
+@bp.route("/")
 def home():
     return render_template("index.html")
 
 DATABASE_URL = os.getenv('DATABASE_URL')
 
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        print("Conexión a la base de datos exitosa.")
+# Tamaño del pool de conexiones (por worker de gunicorn)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '5'))
+# Segundos máximos esperando una conexión libre antes de fallar
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+# Una conexión ociosa más tiempo que esto se verifica con SELECT 1 antes de usarse
+DB_HEALTHCHECK_AFTER = float(os.getenv('DB_HEALTHCHECK_AFTER', '30'))
+# Quién aplica las migraciones: 'worker' (cada worker antes de usar su pool),
+# 'master' (una vez en el maestro de gunicorn, ver gunicorn.conf.py) u 'off'
+# (se corren en el deploy con `flask migrate`)
+SCHEMA_MIGRATIONS_ON = os.getenv('SCHEMA_MIGRATIONS_ON', 'worker')
+
+class DatabasePool:
+    # Pool acotado de conexiones psycopg2. ThreadedConnectionPool falla en
+    # lugar de esperar cuando se agota, así que un semáforo limita los
+    # préstamos y permite esperar hasta DB_POOL_TIMEOUT segundos.
+    def __init__(self, minconn, maxconn, timeout):
+        import psycopg2.pool
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, DATABASE_URL, sslmode='require'
+        )
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.stats = {
+            'checkouts': 0,
+            'in_use': 0,
+            'max_in_use': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+            'timeouts': 0,
+            'healthcheck_failures': 0,
+        }
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats['timeouts'] += 1
+            import psycopg2.pool
+            raise psycopg2.pool.PoolError(
+                f"No hay conexiones libres tras {self.timeout}s (máximo {self.maxconn})"
+            )
+        waited = time.monotonic() - started
+        try:
+            conn = self._checked_conn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.stats['checkouts'] += 1
+            self.stats['in_use'] += 1
+            self.stats['max_in_use'] = max(self.stats['max_in_use'], self.stats['in_use'])
+            self.stats['wait_seconds_total'] += waited
+            self.stats['wait_seconds_max'] = max(self.stats['wait_seconds_max'], waited)
         return conn
-    except Exception as e:
-        print(f"Error al conectar a la base de datos: {e}")
-        raise
 
-def create_tables_if_not_exists():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Crear tabla de conversaciones
-    cur.execute('''
+    def _checked_conn(self):
+        conn = self._pool.getconn()
+        # Las conexiones recién abiertas no tienen marca y no se verifican
+        last_used = self._last_used.get(id(conn))
+        idle = time.monotonic() - last_used if last_used is not None else 0
+        if conn.closed or idle > DB_HEALTHCHECK_AFTER:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1')
+                conn.rollback()
+            except Exception as e:
+                logger.warning("Conexión del pool descartada: %s", e)
+                with self._lock:
+                    self.stats['healthcheck_failures'] += 1
+                self._last_used.pop(id(conn), None)
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        return conn
+
+    def putconn(self, conn, close=False):
+        close = close or bool(conn.closed)
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            with self._lock:
+                self.stats['in_use'] -= 1
+            self._slots.release()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['max_size'] = self.maxconn
+        stats['idle'] = len(self._pool._pool)
+        return stats
+
+    def closeall(self):
+        self._pool.closeall()
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+class DatabaseNotConfigured(RuntimeError):
+    pass
+
+def get_db_pool():
+    # Cada worker de gunicorn crea su propio pool: las conexiones no se
+    # pueden compartir entre procesos después del fork.
+    global _db_pool, _db_pool_pid
+    if not DATABASE_URL:
+        # Sin esto psycopg2 usaría los valores por defecto de libpq (el socket
+        # local), que dependen de la máquina
+        raise DatabaseNotConfigured("DATABASE_URL no está configurada")
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != os.getpid():
+                pool = DatabasePool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT)
+                # El pool se publica recién con el esquema al día: otros hilos
+                # que lo vean antes podrían consultar tablas que aún no existen
+                if SCHEMA_MIGRATIONS_ON == 'worker':
+                    try:
+                        migrate_schema(pool)
+                    except Exception:
+                        logger.exception("Error aplicando las migraciones")
+                _db_pool = pool
+                _db_pool_pid = os.getpid()
+    return _db_pool
+
+def db_pool_stats():
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        return {'max_size': DB_POOL_MAX, 'initialized': False}
+    return _db_pool.snapshot()
+
+@contextmanager
+def db_transaction():
+    # Presta una conexión del pool y ejecuta todo en una sola transacción
+    pool = get_db_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        with conn.cursor() as cur:
+            yield cur
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+
+# Migraciones del esquema, en orden. Se aplican según SCHEMA_MIGRATIONS_ON;
+# un advisory lock evita que dos procesos migren a la vez y schema_migrations
+# registra las versiones ya aplicadas. Las marcadas como concurrentes (CREATE
+# INDEX CONCURRENTLY) no pueden correr dentro de una transacción.
+SCHEMA_MIGRATIONS_LOCK = 72910016
+
+SCHEMA_MIGRATIONS = [
+    (1, 'Tablas iniciales', False, [
+        # Crear tabla de conversaciones
+        '''
         CREATE TABLE IF NOT EXISTS conversations (
             id SERIAL PRIMARY KEY,
             user_id UUID NOT NULL,
             timestamp TIMESTAMPTZ NOT NULL,
             end_timestamp TIMESTAMPTZ
         )
-    ''')
-
-    # Crear tabla de conteo diario
-    cur.execute('''
+        ''',
+        # Crear tabla de conteo diario
+        '''
         CREATE TABLE IF NOT EXISTS daily_counts (
             date DATE PRIMARY KEY,
             count INTEGER NOT NULL DEFAULT 0
         )
-    ''')
-
-    # Crear tabla de conteo mensual
-    cur.execute('''
+        ''',
+        # Crear tabla de conteo mensual
+        '''
         CREATE TABLE IF NOT EXISTS monthly_counts (
             year INTEGER NOT NULL,
             month INTEGER NOT NULL,
             count INTEGER NOT NULL DEFAULT 0,
             PRIMARY KEY (year, month)
         )
-    ''')
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+        ''',
+        # Crear tabla de mensajes (historial del chat, por user_id o teléfono)
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id BIGSERIAL PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS messages_user_id_idx ON messages (user_id, id)',
+    ]),
+    (3, 'Prefijo de canal en el historial', False, [
+        # Los user_id de la web son UUID; el resto son teléfonos de WhatsApp
+        '''
+        UPDATE messages SET user_id = 'web:' || user_id
+        WHERE user_id ~* '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+        ''',
+        "UPDATE messages SET user_id = 'wa:' || user_id WHERE user_id !~ '^(web|wa):'",
+    ]),
+    (2, 'Índice parcial de conversaciones abiertas', True, [
+        # Un intento anterior interrumpido deja el índice marcado como inválido
+        'DROP INDEX CONCURRENTLY IF EXISTS conversations_open_idx',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS conversations_open_idx
+        ON conversations (user_id, timestamp DESC) WHERE end_timestamp IS NULL
+        ''',
+    ]),
+]
+
+def migrate_schema(pool):
+    conn = pool.getconn()
+    broken = False
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            # pg_try_advisory_lock en lugar de esperar bloqueado: una sesión
+            # esperando el lock frenaría el CREATE INDEX CONCURRENTLY del otro
+            waiting = False
+            while True:
+                cur.execute('SELECT pg_try_advisory_lock(%s)', (SCHEMA_MIGRATIONS_LOCK,))
+                if cur.fetchone()[0]:
+                    break
+                if not waiting:
+                    logger.info("Esperando a que otro proceso termine las migraciones")
+                    waiting = True
+                time.sleep(0.5)
+
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            ''')
+            cur.execute('SELECT version FROM schema_migrations')
+            applied = {row[0] for row in cur.fetchall()}
+            for version, description, concurrent, statements in SCHEMA_MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info("Aplicando migración %s: %s", version, description)
+                if not concurrent:
+                    cur.execute('BEGIN')
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute(
+                    'INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+                    (version, description)
+                )
+                if not concurrent:
+                    cur.execute('COMMIT')
+            cur.execute('SELECT pg_advisory_unlock(%s)', (SCHEMA_MIGRATIONS_LOCK,))
+        conn.autocommit = False
+    except Exception:
+        # Cerrar la conexión descarta la transacción a medias y libera el lock
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+
+def run_migrations():
+    # Con una conexión propia que se cierra al terminar: en el maestro de
+    # gunicorn no debe quedar ninguna abierta que los workers hereden
+    pool = DatabasePool(1, 1, DB_POOL_TIMEOUT)
+    try:
+        migrate_schema(pool)
+    finally:
+        pool.closeall()
+
+@bp.cli.command('migrate')
+def migrate_command():
+    run_migrations()
+    print("Esquema actualizado")
+
+# Los helpers aceptan un cursor opcional para poder participar en una
+# transacción abierta (ver process_message); sin cursor abren la suya.
+
+@stage_metrics.instrument('db.create_conversation')
+def create_new_conversation(user_id, cur=None):
+    if cur is None:
+        with db_transaction() as cur:
+            return create_new_conversation(user_id, cur)
 
-def create_new_conversation(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     # Crear una nueva conversación
     cur.execute('''
         INSERT INTO conversations (user_id, timestamp)
         VALUES (%s, %s) RETURNING id
     ''', (user_id, datetime.now(timezone.utc)))
-    
-    conversation_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
-    
-    return conversation_id
 
-def get_current_conversation(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
+    return cur.fetchone()[0]
+
+@stage_metrics.instrument('db.get_current_conversation')
+def get_current_conversation(user_id, cur=None, for_update=False):
+    if cur is None:
+        with db_transaction() as cur:
+            return get_current_conversation(user_id, cur, for_update)
+
     # Buscar la última conversación activa para el usuario
     cur.execute('''
         SELECT id, timestamp FROM conversations 
         WHERE user_id = %s AND end_timestamp IS NULL
         ORDER BY timestamp DESC LIMIT 1
-    ''', (user_id,))
-    
-    conversation = cur.fetchone()
-    
-    cur.close()
-    conn.close()
-    
-    return conversation
+    ''' + (' FOR UPDATE' if for_update else ''), (user_id,))
+
+    return cur.fetchone()
+
+@stage_metrics.instrument('db.end_conversation')
+def end_conversation(conversation_id, cur=None):
+    if cur is None:
+        with db_transaction() as cur:
+            return end_conversation(conversation_id, cur)
 
-def end_conversation(conversation_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
     # Finalizar la conversación
     cur.execute('''
         UPDATE conversations
         SET end_timestamp = %s
         WHERE id = %s
     ''', (datetime.now(timezone.utc), conversation_id))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def update_counts():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    now = datetime.now(timezone.utc)
-    today = now.date()
-    month = today.month
-    year = today.year
+# Los conteos de conversaciones se acumulan en memoria y se escriben en lote
+# (cada COUNTS_FLUSH_INTERVAL segundos o COUNTS_FLUSH_EVENTS eventos) para no
+# pelear por las mismas dos filas en cada conversación nueva.
+COUNTS_FLUSH_INTERVAL = float(os.getenv('COUNTS_FLUSH_INTERVAL', '10'))
+COUNTS_FLUSH_EVENTS = int(os.getenv('COUNTS_FLUSH_EVENTS', '100'))
+
+class CountsAggregator:
+    def __init__(self, interval, max_events):
+        self.interval = interval
+        self.max_events = max_events
+        self._daily = {}
+        self._monthly = {}
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self.stats = {'increments': 0, 'flushes': 0, 'rows_written': 0, 'flush_errors': 0}
+
+    def increment(self):
+        self._ensure_started()
+        today = datetime.now(timezone.utc).date()
+        with self._lock:
+            self._daily[today] = self._daily.get(today, 0) + 1
+            month = (today.year, today.month)
+            self._monthly[month] = self._monthly.get(month, 0) + 1
+            self._events += 1
+            self.stats['increments'] += 1
+            if self._events >= self.max_events:
+                self._wakeup.set()
+
+    def _ensure_started(self):
+        # Un hilo de volcado por worker de gunicorn
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._daily, self._monthly, self._events = {}, {}, 0
+                threading.Thread(target=self._run, daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    @stage_metrics.instrument('db.flush_counts')
+    def flush(self):
+        if not DATABASE_URL:
+            return  # sin base los conteos quedan en memoria (ver get_counts)
+        with self._flush_lock:
+            with self._lock:
+                daily, monthly = self._daily, self._monthly
+                self._daily, self._monthly, self._events = {}, {}, 0
+            if not daily and not monthly:
+                return
+            try:
+                with db_transaction() as cur:
+                    # Una sola sentencia para ambas tablas
+                    cur.execute('''
+                        WITH daily AS (
+                            INSERT INTO daily_counts (date, count)
+                            SELECT * FROM unnest(%s::date[], %s::int[])
+                            ON CONFLICT (date)
+                            DO UPDATE SET count = daily_counts.count + EXCLUDED.count
+                        )
+                        INSERT INTO monthly_counts (year, month, count)
+                        SELECT * FROM unnest(%s::int[], %s::int[], %s::int[])
+                        ON CONFLICT (year, month)
+                        DO UPDATE SET count = monthly_counts.count + EXCLUDED.count
+                    ''', (
+                        list(daily), list(daily.values()),
+                        [year for year, _ in monthly], [month for _, month in monthly], list(monthly.values()),
+                    ))
+                self.stats['flushes'] += 1
+                self.stats['rows_written'] += len(daily) + len(monthly)
+            except Exception as e:
+                # Devolver los incrementos para reintentar en el próximo volcado
+                logger.warning("Error guardando los conteos: %s", e)
+                self.stats['flush_errors'] += 1
+                with self._lock:
+                    for day, count in daily.items():
+                        self._daily[day] = self._daily.get(day, 0) + count
+                    for month, count in monthly.items():
+                        self._monthly[month] = self._monthly.get(month, 0) + count
+
+    def pending(self):
+        with self._lock:
+            return dict(self._daily), dict(self._monthly)
+
+    def snapshot(self):
+        daily, monthly = self.pending()
+        stats = dict(self.stats)
+        stats['pending_daily'] = sum(daily.values())
+        stats['pending_monthly'] = sum(monthly.values())
+        return stats
+
+counts_aggregator = CountsAggregator(COUNTS_FLUSH_INTERVAL, COUNTS_FLUSH_EVENTS)
+# Volcar lo pendiente cuando el worker termina
+atexit.register(counts_aggregator.flush)
 
-    # Actualizar conteo diario
-    cur.execute('''
-        INSERT INTO daily_counts (date, count)
-        VALUES (%s, 1)
-        ON CONFLICT (date) 
-        DO UPDATE SET count = daily_counts.count + 1
-    ''', (today,))
-    
-    # Actualizar conteo mensual
-    cur.execute('''
-        INSERT INTO monthly_counts (year, month, count)
-        VALUES (%s, %s, 1)
-        ON CONFLICT (year, month) 
-        DO UPDATE SET count = monthly_counts.count + 1
-    ''', (year, month))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
+def update_counts():
+    counts_aggregator.increment()
+
+@stage_metrics.instrument('db.get_counts')
+def get_counts(day=None):
+    # Conteo del día y del mes sumando lo guardado y lo pendiente de volcar.
+    # Sin DATABASE_URL solo están los conteos en memoria de este worker
+    # (persisted: false).
+    day = day or datetime.now(timezone.utc).date()
+    daily = monthly = 0
+    if DATABASE_URL:
+        with db_transaction() as cur:
+            cur.execute('SELECT count FROM daily_counts WHERE date = %s', (day,))
+            row = cur.fetchone()
+            daily = row[0] if row else 0
+            cur.execute('SELECT count FROM monthly_counts WHERE year = %s AND month = %s', (day.year, day.month))
+            row = cur.fetchone()
+            monthly = row[0] if row else 0
+    pending_daily, pending_monthly = counts_aggregator.pending()
+    return {
+        'date': day.isoformat(),
+        'daily': daily + pending_daily.get(day, 0),
+        'monthly': monthly + pending_monthly.get((day.year, day.month), 0),
+        'persisted': bool(DATABASE_URL),
+    }
 
+# Una conversación se cierra a los CONVERSATION_TIMEOUT segundos de iniciada:
+# cuando el usuario vuelve a escribir (process_message) o en el barrido
+# periódico, que cierra en lote las que quedaron abiertas.
+CONVERSATION_TIMEOUT = timedelta(seconds=float(os.getenv('CONVERSATION_TIMEOUT', '300')))
+CONVERSATION_SWEEP_INTERVAL = float(os.getenv('CONVERSATION_SWEEP_INTERVAL', '60'))  # 0 desactiva el barrido
+CONVERSATION_SWEEP_BATCH = int(os.getenv('CONVERSATION_SWEEP_BATCH', '1000'))
+CONVERSATION_SWEEP_LOCK = 72910017
+ACTIVE_CONVERSATION_CACHE_SIZE = int(os.getenv('ACTIVE_CONVERSATION_CACHE_SIZE', '10000'))
+
+class ActiveConversationCache:
+    # Conversación abierta de cada usuario (id y hora de inicio) por worker.
+    # Una entrada solo se usa mientras no venció: las rotaciones y el barrido
+    # dependen únicamente de la hora de inicio, así que una conversación
+    # vigente no pudo haber sido cerrada por otro worker.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, user_id, now):
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or now - entry[1] > CONVERSATION_TIMEOUT:
+                self.stats['misses'] += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.stats['hits'] += 1
+            return entry
+
+    def set(self, user_id, conversation_id, start_time):
+        with self._lock:
+            self._data[user_id] = (conversation_id, start_time)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                if self._data.pop(user_id, None) is not None:
+                    self.stats['invalidations'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._data)
+        stats['max_size'] = self.maxsize
+        return stats
+
+active_conversations = ActiveConversationCache(ACTIVE_CONVERSATION_CACHE_SIZE)
+
+class ConversationSweeper:
+    # Un hilo por worker; en cada vuelta solo barre el que obtiene el advisory
+    # lock. La consulta usa el índice parcial conversations_open_idx, que solo
+    # contiene conversaciones abiertas.
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {'runs': 0, 'skipped': 0, 'closed': 0, 'errors': 0, 'last_run': None}
+
+    def start(self):
+        if self.interval <= 0 or not DATABASE_URL or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception:
+                self.stats['errors'] += 1
+                logger.exception("Error cerrando conversaciones vencidas")
+
+    @stage_metrics.instrument('db.sweep_conversations')
+    def sweep(self):
+        closed = 0
+        while True:
+            now = datetime.now(timezone.utc)
+            with db_transaction() as cur:
+                cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (CONVERSATION_SWEEP_LOCK,))
+                if not cur.fetchone()[0]:
+                    self.stats['skipped'] += 1
+                    return closed
+                # SKIP LOCKED: las que process_message tiene tomadas se cierran ahí
+                cur.execute('''
+                    UPDATE conversations SET end_timestamp = %s
+                    WHERE id IN (
+                        SELECT id FROM conversations
+                        WHERE end_timestamp IS NULL AND timestamp < %s
+                        LIMIT %s FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING user_id
+                ''', (now, now - CONVERSATION_TIMEOUT, self.batch_size))
+                user_ids = [str(row[0]) for row in cur.fetchall()]
+            active_conversations.invalidate(user_ids)
+            closed += len(user_ids)
+            if len(user_ids) < self.batch_size:
+                break
+        self.stats['runs'] += 1
+        self.stats['closed'] += closed
+        self.stats['last_run'] = now.isoformat()
+        return closed
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats['interval'] = self.interval
+        return stats
+
+conversation_sweeper = ConversationSweeper(CONVERSATION_SWEEP_INTERVAL, CONVERSATION_SWEEP_BATCH)
+
+@stage_metrics.instrument('process_message')
 def process_message(user_id, message):
-    conversation = get_current_conversation(user_id)
     current_time = datetime.now(timezone.utc)  # Asegúrate de que sea offset-aware
-    
-    if conversation:
-        conversation_id, start_time = conversation
-        
-        # Asegúrate de que start_time sea offset-aware
-        if start_time.tzinfo is None:
-            start_time = start_time.replace(tzinfo=timezone.utc)
-        
-        # Si la conversación es mayor a 5 minutos, ciérrala y crea una nueva
-        if current_time - start_time > timedelta(minutes=5):
-            end_conversation(conversation_id)
-            conversation_id = create_new_conversation(user_id)
-            update_counts()  # Actualiza el conteo al finalizar una conversación
+
+    # Conversación vigente en memoria: no hace falta ir a la base
+    cached = active_conversations.get(user_id, current_time)
+    if cached:
+        conversation_id = cached[0]
+        logger.debug("Continuando la conversación con ID: %s", conversation_id)
+        return f"Mensaje recibido en la conversación {conversation_id}"
+
+    # Búsqueda y rotación en una única transacción y conexión
+    started_new = False
+    with db_transaction() as cur:
+        conversation = get_current_conversation(user_id, cur, for_update=True)
+
+        if conversation:
+            conversation_id, start_time = conversation
+            
+            # Asegúrate de que start_time sea offset-aware
+            if start_time.tzinfo is None:
+                start_time = start_time.replace(tzinfo=timezone.utc)
+            
+            # Si la conversación es mayor a 5 minutos, ciérrala y crea una nueva
+            if current_time - start_time > CONVERSATION_TIMEOUT:
+                end_conversation(conversation_id, cur)
+                conversation_id = create_new_conversation(user_id, cur)
+                start_time = current_time
+                started_new = True
+            else:
+                logger.debug("Continuando la conversación con ID: %s", conversation_id)
         else:
-            print(f"Continuando la conversación con ID: {conversation_id}")
-    else:
-        conversation_id = create_new_conversation(user_id)
-        update_counts()  # Actualiza el conteo al iniciar una nueva conversación
-        print(f"Iniciando una nueva conversación con ID: {conversation_id}")
+            conversation_id = create_new_conversation(user_id, cur)
+            start_time = current_time
+            started_new = True
+            logger.debug("Iniciando una nueva conversación con ID: %s", conversation_id)
+
+    # La caché y el conteo se actualizan una vez confirmada la transacción; la
+    # entrada nueva reemplaza a la de la conversación rotada
+    active_conversations.set(user_id, conversation_id, start_time)
+    if started_new:
+        update_counts()
     
     # Aquí procesarías el mensaje según sea necesario
     return f"Mensaje recibido en la conversación {conversation_id}"
 
-@app.before_request
+# Historial del chat guardado en el servidor (tabla messages) con una caché
+# en memoria de escritura directa. La cookie solo lleva el user_id.
+# Las claves llevan el canal como prefijo ('web:<uuid>', 'wa:<teléfono>'):
+# así ninguna cookie puede apuntar al historial de un cliente de WhatsApp.
+def web_conversation_key(user_id):
+    return f"web:{user_id}"
+
+def whatsapp_conversation_key(phone_number):
+    return f"wa:{phone_number}"
+
+def parse_user_id(value):
+    # Solo se aceptan los UUID que emite la app; None si la cookie trae otra cosa
+    try:
+        return str(uuid.UUID(value))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+CONVERSATION_MAX_TURNS = int(os.getenv('CONVERSATION_MAX_TURNS', '10'))  # pares usuario/asistente
+CONVERSATION_CACHE_SIZE = int(os.getenv('CONVERSATION_CACHE_SIZE', '1000'))
+
+class ConversationStore:
+    # Sin base configurada (persistent=False) el historial vive solo en la
+    # caché del worker, igual que /readyz lo informa como not_configured.
+    def __init__(self, max_messages, cache_size, persistent=True):
+        self.max_messages = max_messages
+        self.cache_size = cache_size
+        self.persistent = persistent
+        # user_id -> (id del último mensaje leído de la base, [(id, mensaje)])
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'full_reads': 0, 'incremental_reads': 0, 'rows_from_db': 0, 'db_errors': 0}
+
+    @stage_metrics.instrument('db.history')
+    def history(self, user_id):
+        # Devuelve los últimos mensajes. La base se consulta siempre: cualquier
+        # worker puede atender el próximo mensaje del mismo usuario (la cola de
+        # webhooks es compartida y el balanceador no fija sesiones), así que la
+        # caché solo evita releer el historial completo; con la entrada en caché
+        # se leen únicamente los mensajes con id mayor al último leído.
+        with self._lock:
+            entry = self._cache.get(user_id)
+            if entry is not None:
+                self._cache.move_to_end(user_id)
+        last_id, messages = entry if entry is not None else (None, [])
+        if not self.persistent:
+            return [message for _, message in messages]
+        failed = False
+        try:
+            with db_transaction() as cur:
+                if last_id is None:
+                    cur.execute('''
+                        SELECT id, role, content FROM (
+                            SELECT id, role, content FROM messages
+                            WHERE user_id = %s ORDER BY id DESC LIMIT %s
+                        ) recent ORDER BY id
+                    ''', (user_id, self.max_messages))
+                else:
+                    cur.execute('''
+                        SELECT id, role, content FROM messages
+                        WHERE user_id = %s AND id > %s ORDER BY id
+                    ''', (user_id, last_id))
+                rows = cur.fetchall()
+        except Exception as e:
+            logger.error("Error leyendo el historial de %s: %s", user_id, e)
+            self.stats['db_errors'] += 1
+            rows, failed = [], True
+        self.stats['full_reads' if last_id is None else 'incremental_reads'] += 1
+
+        if rows:
+            last_id = rows[-1][0]
+            messages = self._merge(messages, rows)
+        elif last_id is None and not failed:
+            # Usuario sin historial en la base: las próximas lecturas son incrementales
+            last_id = 0
+        messages = messages[-self.max_messages:]
+        self._remember(user_id, last_id, messages)
+        return [message for _, message in messages]
+
+    def _merge(self, messages, rows):
+        # Los mensajes guardados por este worker ya están en la caché con su id;
+        # se agregan solo los que escribió otro y se reordena por id. Los que no
+        # llegaron a la base (id None) quedan detrás del mensaje anterior.
+        known = {message_id for message_id, _ in messages if message_id is not None}
+        new = [(message_id, {"role": role, "content": content})
+               for message_id, role, content in rows if message_id not in known]
+        if not new:
+            return messages
+        self.stats['rows_from_db'] += len(new)
+        merged = messages + new
+        order = []
+        previous = 0
+        for message_id, _ in merged:
+            previous = message_id if message_id is not None else previous
+            order.append(previous)
+        return [merged[i] for i in sorted(range(len(merged)), key=lambda i: (order[i], i))]
+
+    @stage_metrics.instrument('db.append_message')
+    def append(self, user_id, role, content):
+        message_id = None
+        try:
+            if self.persistent:
+                with db_transaction() as cur:
+                    cur.execute('''
+                        INSERT INTO messages (user_id, role, content)
+                        VALUES (%s, %s, %s) RETURNING id
+                    ''', (user_id, role, content))
+                    message_id = cur.fetchone()[0]
+        except Exception as e:
+            # Si la base falla el turno queda al menos en la caché del worker
+            logger.error("Error guardando el mensaje de %s: %s", user_id, e)
+            self.stats['db_errors'] += 1
+        with self._lock:
+            entry = self._cache.get(user_id)
+        if entry is None and not self.persistent:
+            entry = (None, [])
+        # Sin entrada en caché el historial se cargará completo en la próxima lectura.
+        # last_id no avanza: otro worker pudo insertar mensajes con id menor que
+        # todavía no se leyeron; el id queda en la caché para no duplicarlo.
+        if entry is not None:
+            last_id, messages = entry
+            messages = (messages + [(message_id, {"role": role, "content": content})])[-self.max_messages:]
+            self._remember(user_id, last_id, messages)
+
+    @stage_metrics.instrument('db.reset_history')
+    def reset(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+        if not self.persistent:
+            return
+        try:
+            with db_transaction() as cur:
+                cur.execute('DELETE FROM messages WHERE user_id = %s', (user_id,))
+        except Exception as e:
+            logger.error("Error borrando el historial de %s: %s", user_id, e)
+            self.stats['db_errors'] += 1
+
+    def _remember(self, user_id, last_id, messages):
+        with self._lock:
+            self._cache[user_id] = (last_id, messages)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['cached_users'] = len(self._cache)
+        stats['persistent'] = self.persistent
+        return stats
+
+conversation_store = ConversationStore(CONVERSATION_MAX_TURNS * 2, CONVERSATION_CACHE_SIZE, persistent=bool(DATABASE_URL))
+
+@bp.before_app_request
+def assign_request_id():
+    # Se respeta el X-Request-ID que llega del proxy o se genera uno nuevo
+    request_id_var.set(request.headers.get('X-Request-ID') or uuid.uuid4().hex)
+
+@bp.before_app_request
+def start_request_metrics():
+    request.environ['chatbot.started'] = time.perf_counter()
+    request_timings_var.set([] if SERVER_TIMING else None)
+
+@bp.before_app_request
 def ensure_user_id():
-    user_id = request.cookies.get('user_id')
+    user_id = parse_user_id(request.cookies.get('user_id'))
     if not user_id:
         user_id = str(uuid.uuid4())
-        session['user_id'] = user_id
-        print(f"Nuevo user_id generado: {user_id}")
-    else:
-        session['user_id'] = user_id
-        print(f"User_id recuperado de la cookie: {user_id}")
+        logger.debug("Nuevo user_id generado: %s", user_id)
+    session['user_id'] = user_id
+
+@bp.before_app_request
+def start_background_jobs():
+    start_catalog_refresher()
+    conversation_sweeper.start()
+    # También los workers que no reciben webhooks toman mensajes de la cola compartida
+    webhook_dispatcher.start()
 
-@app.after_request
+@bp.after_app_request
 def set_user_id_cookie(response):
     if 'user_id' in session:
-        response.set_cookie('user_id', session['user_id'])
+        response.set_cookie('user_id', session['user_id'], max_age=60*60*24*365*2)
+    return response
+
+@bp.after_app_request
+def set_request_id_header(response):
+    response.headers['X-Request-ID'] = request_id_var.get()
+    return response
+
+@bp.after_app_request
+def record_request_metrics(response):
+    # En las respuestas SSE esto mide hasta que empieza el stream
+    started = request.environ.get('chatbot.started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    stage_metrics.observe_request(route, request.method, response.status_code, elapsed)
+    timings = request_timings_var.get()
+    if timings is not None:
+        response.headers['Server-Timing'] = server_timing_header(timings, elapsed)
     return response
 
 
-@app.route('/webhook', methods=['GET', 'POST'])
+# Cola de procesamiento del webhook de WhatsApp. El webhook solo valida,
+# encola y responde; un grupo de hilos procesa los mensajes. La cola y los IDs
+# ya vistos viven en un archivo SQLite local que comparten todos los workers de
+# gunicorn: un reintento de Meta que llega a otro worker se descarta igual, y
+# un mensaje no se toma mientras quede uno anterior del mismo número, así cada
+# número se procesa en orden aunque sus entregas caigan en workers distintos.
+WEBHOOK_QUEUE_PATH = os.getenv('WEBHOOK_QUEUE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webhook_queue.db'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '4'))  # hilos por worker de gunicorn
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '2000'))  # mensajes pendientes entre todos los workers
+WEBHOOK_DEDUP_TTL = float(os.getenv('WEBHOOK_DEDUP_TTL', '86400'))
+# Sin mensajes, cada hilo vuelve a mirar la cola cada este intervalo (los que
+# encola el mismo worker lo despiertan antes)
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', '0.2'))
+WEBHOOK_ORPHAN_CHECK_INTERVAL = 30
+# Entregas con varios mensajes: hilos que preparan los lotes y búsquedas del
+# catálogo en paralelo por lote
+WEBHOOK_BATCH_THREADS = int(os.getenv('WEBHOOK_BATCH_THREADS', '2'))
+WEBHOOK_BATCH_LOOKUPS = int(os.getenv('WEBHOOK_BATCH_LOOKUPS', '8'))
+WEBHOOK_PREPARE_TIMEOUT = float(os.getenv('WEBHOOK_PREPARE_TIMEOUT', '30'))
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class WebhookQueue:
+    def __init__(self, path, maxsize, dedup_ttl):
+        self.path = path
+        self.maxsize = maxsize
+        self.dedup_ttl = dedup_ttl
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Sin transacciones implícitas: encolar y tomar mensajes usan BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS webhook_messages (
+                    message_id TEXT PRIMARY KEY,
+                    received_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS webhook_messages_received_idx ON webhook_messages (received_at);
+                CREATE TABLE IF NOT EXISTS webhook_jobs (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    message_id TEXT,
+                    phone TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    request_id TEXT,
+                    batch TEXT,
+                    enqueued_by INTEGER NOT NULL,
+                    claimed_by INTEGER,
+                    claimed_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS webhook_jobs_phone_idx ON webhook_jobs (phone, seq);
+            ''')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def enqueue(self, jobs, batch=None):
+        # Devuelve los mensajes nuevos (sin los IDs ya vistos). Si no entran
+        # todos lanza queue.Full y no se guarda nada de la entrega.
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM webhook_messages WHERE received_at < ?', (now - self.dedup_ttl,))
+            fresh = []
+            for job in jobs:
+                if job['id']:
+                    cursor = conn.execute(
+                        'INSERT INTO webhook_messages (message_id, received_at) VALUES (?, ?) '
+                        'ON CONFLICT (message_id) DO NOTHING', (job['id'], now)
+                    )
+                    if not cursor.rowcount:
+                        continue
+                fresh.append(job)
+            pending = conn.execute('SELECT count(*) FROM webhook_jobs').fetchone()[0]
+            if pending + len(fresh) > self.maxsize:
+                raise queue.Full
+            conn.executemany(
+                'INSERT INTO webhook_jobs (message_id, phone, text, request_id, batch, enqueued_by) VALUES (?, ?, ?, ?, ?, ?)',
+                [(job['id'], job['from'], job['text'], job.get('request_id'), batch, os.getpid()) for job in fresh]
+            )
+        return fresh
+
+    def claim(self):
+        # Toma el mensaje más viejo cuyo número no tenga otro anterior pendiente
+        # (en curso en cualquier worker o todavía en la cola). Se prefieren los
+        # encolados por este proceso, que tienen su lote preparado acá.
+        conn = self._conn()
+        # Lectura sin lock: con la cola vacía no se abre una transacción de escritura
+        if conn.execute('SELECT 1 FROM webhook_jobs WHERE claimed_by IS NULL LIMIT 1').fetchone() is None:
+            return None
+        pid = os.getpid()
+        with self._transaction() as conn:
+            row = conn.execute('''
+                SELECT seq, message_id, phone, text, request_id, batch FROM webhook_jobs AS j
+                WHERE claimed_by IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM webhook_jobs AS p WHERE p.phone = j.phone AND p.seq < j.seq)
+                ORDER BY enqueued_by != ?, seq
+                LIMIT 1
+            ''', (pid,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE webhook_jobs SET claimed_by = ?, claimed_at = ? WHERE seq = ?', (pid, time.time(), row[0]))
+        return {'seq': row[0], 'id': row[1], 'from': row[2], 'text': row[3], 'request_id': row[4], 'batch': row[5]}
+
+    def complete(self, seq):
+        self._conn().execute('DELETE FROM webhook_jobs WHERE seq = ?', (seq,))
+
+    def release_orphans(self):
+        # Los mensajes tomados por un worker que ya no existe (reinicio o caída)
+        # vuelven a la cola; pueden llegar a responderse dos veces
+        conn = self._conn()
+        released = 0
+        for (pid,) in conn.execute('SELECT DISTINCT claimed_by FROM webhook_jobs WHERE claimed_by IS NOT NULL').fetchall():
+            if pid != os.getpid() and not _pid_alive(pid):
+                released += conn.execute(
+                    'UPDATE webhook_jobs SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?', (pid,)
+                ).rowcount
+        return released
+
+    def snapshot(self):
+        try:
+            queued, in_progress = self._conn().execute(
+                'SELECT count(*), count(claimed_by) FROM webhook_jobs'
+            ).fetchone()
+        except sqlite3.Error as e:
+            return {'error': str(e)}
+        return {'queued': queued - in_progress, 'in_progress': in_progress, 'max_size': self.maxsize}
+
+class WebhookDispatcher:
+    # Una entrega con varios mensajes se prepara en lote (preparer) mientras
+    # sus mensajes ya esperan en la cola: los hilos de este proceso que toman
+    # un mensaje del lote esperan a que esté listo antes de procesarlo.
+    def __init__(self, store, workers, handler, preparer=None):
+        self.store = store
+        self.workers = workers
+        self.handler = handler
+        self.preparer = preparer
+        self._batches = {}
+        self._batch_executor = None
+        self._wakeup = threading.Condition()
+        self._orphans_checked_at = 0.0
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {'enqueued': 0, 'processed': 0, 'failed': 0, 'rejected': 0, 'duplicates': 0,
+                      'batches': 0, 'batched_messages': 0, 'batch_errors': 0, 'orphans_released': 0,
+                      'queue_errors': 0}
+
+    def start(self):
+        # Los hilos se crean en cada worker de gunicorn después del fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._batches = {}
+                self._batch_executor = ThreadPoolExecutor(WEBHOOK_BATCH_THREADS, thread_name_prefix='webhook-batch')
+                for _ in range(self.workers):
+                    threading.Thread(target=self._run, daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit_delivery(self, jobs):
+        # Encola los mensajes de una entrega; devuelve los nuevos, o None si
+        # la cola está llena (en ese caso no se encoló ninguno)
+        self.start()
+        batch = prepared = None
+        if self.preparer is not None and len(jobs) > 1:
+            # El lote se registra antes de encolar para que ningún hilo lo tome sin esperar
+            batch, prepared = uuid.uuid4().hex, threading.Event()
+            self._batches[batch] = prepared
+        try:
+            accepted = self.store.enqueue(jobs, batch)
+        except BaseException as e:
+            if batch is not None:
+                self._batches.pop(batch, None)
+            if isinstance(e, queue.Full):
+                self.stats['rejected'] += len(jobs)
+                return None
+            raise
+        self.stats['duplicates'] += len(jobs) - len(accepted)
+        self.stats['enqueued'] += len(accepted)
+        if batch is not None:
+            if len(accepted) > 1:
+                self._batch_executor.submit(self._prepare, batch, accepted, prepared)
+            else:
+                self._batches.pop(batch, None)
+                prepared.set()
+        with self._wakeup:
+            self._wakeup.notify(len(accepted))
+        return accepted
+
+    def _prepare(self, batch, jobs, prepared):
+        try:
+            self.preparer(jobs)
+            self.stats['batches'] += 1
+            self.stats['batched_messages'] += len(jobs)
+        except Exception:
+            self.stats['batch_errors'] += 1
+            logger.exception("Error preparando el lote del webhook")
+        finally:
+            self._batches.pop(batch, None)
+            prepared.set()
+
+    def _release_orphans(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._orphans_checked_at < WEBHOOK_ORPHAN_CHECK_INTERVAL:
+                return
+            self._orphans_checked_at = now
+        released = self.store.release_orphans()
+        if released:
+            self.stats['orphans_released'] += released
+            logger.warning("%d mensajes del webhook de un worker caído vuelven a la cola", released)
+
+    def _run(self):
+        while True:
+            try:
+                job = self.store.claim()
+                if job is None:
+                    self._release_orphans()
+            except sqlite3.Error:
+                self.stats['queue_errors'] += 1
+                logger.exception("Error leyendo la cola del webhook")
+                job = None
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(WEBHOOK_POLL_INTERVAL)
+                continue
+            try:
+                # Si el lote falla o tarda demasiado el mensaje se procesa igual, sin la preparación
+                prepared = self._batches.get(job['batch']) if job['batch'] else None
+                if prepared is not None:
+                    prepared.wait(WEBHOOK_PREPARE_TIMEOUT)
+                self.handler(job)
+                self.stats['processed'] += 1
+            except Exception:
+                self.stats['failed'] += 1
+                logger.exception("Error procesando mensaje de WhatsApp")
+            finally:
+                try:
+                    self.store.complete(job['seq'])
+                except sqlite3.Error:
+                    self.stats['queue_errors'] += 1
+                    logger.exception("Error quitando el mensaje %s de la cola del webhook", job['seq'])
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats['workers'] = self.workers
+        stats.update(self.store.snapshot())
+        return stats
+
+def handle_whatsapp_message(job):
+    phone_number, user_input = job['from'], job['text']
+    # Los registros del hilo llevan el ID de la solicitud que encoló el mensaje
+    request_id_var.set(job.get('request_id'))
+    # El historial de WhatsApp se guarda bajo el número de teléfono
+    response = process_user_input(whatsapp_conversation_key(phone_number), user_input,
+                                  render_products=whatsapp_product_list)
+    if 'whatsapp_list' in response:
+        send_whatsapp_list(phone_number, response['whatsapp_list'])
+    elif 'carousel' in response:
+        send_whatsapp_carousel(phone_number, response['carousel'])
+    else:
+        send_whatsapp_message(phone_number, response['response'])
+
+def prepare_whatsapp_batch(jobs):
+    # Un solo nlp.pipe para todos los textos de la entrega (queda en la caché
+    # del análisis) y una búsqueda por producto distinto, en paralelo, que
+    # deja los resultados en search_cache. Con el índice local listo las
+    # búsquedas ya son baratas y no se anticipan.
+    analyses = analyze_many([job['text'] for job in jobs])
+    if catalog_index.ready():
+        return
+    queries = list(dict.fromkeys(
+        normalize_user_input(product_name) for is_search, product_name in analyses if is_search and product_name
+    ))
+    if not queries:
+        return
+
+    def lookup(query):
+        try:
+            search_cache.get_or_load(query, lambda: load_products(query))
+        except Exception as e:
+            # El mensaje vuelve a intentar la búsqueda al procesarse
+            logger.warning("Error anticipando la búsqueda de '%s': %s", query, e)
+
+    with ThreadPoolExecutor(min(WEBHOOK_BATCH_LOOKUPS, len(queries)), thread_name_prefix='webhook-lookup') as executor:
+        list(executor.map(lookup, queries))
+
+webhook_queue = WebhookQueue(WEBHOOK_QUEUE_PATH, WEBHOOK_QUEUE_SIZE, WEBHOOK_DEDUP_TTL)
+webhook_dispatcher = WebhookDispatcher(webhook_queue, WEBHOOK_WORKERS, handle_whatsapp_message, prepare_whatsapp_batch)
+
+@bp.route('/webhook', methods=['GET', 'POST'])
 def webhook():
     if request.method == 'GET':
         mode = request.args.get('hub.mode')
@@ -214,143 +1475,364 @@ def webhook():
             return 'Forbidden', 403
 
     if request.method == 'POST':
-        data = request.get_json()
-        print(data)  # Depuración
-
-        if data.get('object') == 'whatsapp_business_account':
-            for entry in data.get('entry', []):
-                for change in entry.get('changes', []):
-                    value = change.get('value', {})
-                    messages = value.get('messages', [])
-                    for message in messages:
-                        if message.get('type') == 'text':
-                            phone_number = message['from']
-                            user_input = message['text']['body']
-                            response = process_user_input(user_input)
-                            if 'carousel' in response:
-                                send_whatsapp_carousel(phone_number, response['carousel'])
-                            else:
-                                send_whatsapp_message(phone_number, response['response'])
-        return 'EVENT_RECEIVED', 200
-
-
+        data = request.get_json(silent=True)
+        return enqueue_webhook_payload(data)
 
+def enqueue_webhook_payload(data):
+    # Valida la entrega de Meta y encola sus mensajes de texto; devuelve (cuerpo, estado)
+    if not isinstance(data, dict):
+        return 'Bad Request', 400
 
-def send_whatsapp_message(to, message):
-    url = f"{WHATSAPP_API_URL}/{PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "text",
-        "text": {
-            "body": str(message)  # Asegurarse de que message sea una cadena
-        }
-    }
-    response = requests.post(url, headers=headers, json=data)
-    print(f"Enviando mensaje a {to}: {message}")  # Depuración
-    print(f"Datos enviados: {data}")  # Depuración
-    print(f"Respuesta de la API: {response.json()}")  # Depuración
-    return response.json()
+    if data.get('object') != 'whatsapp_business_account':
+        return 'EVENT_RECEIVED', 200
 
-def send_whatsapp_carousel(to, products):
-    url = f"{WHATSAPP_API_URL}/{PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
-        "Content-Type": "application/json"
-    }
+    # Se juntan todos los mensajes de texto de la entrega para encolarlos como lote
+    jobs = []
+    for entry in data.get('entry', []):
+        for change in entry.get('changes', []):
+            value = change.get('value', {})
+            messages = value.get('messages', [])
+            for message in messages:
+                if message.get('type') == 'text':
+                    jobs.append({'id': message.get('id'), 'from': message['from'], 'text': message['text']['body'], 'request_id': request_id_var.get()})
+    if not jobs:
+        return 'EVENT_RECEIVED', 200
 
-    elements = [
-        {
-            "title": product['title'],
- # Asegúrate de que la URL de la imagen sea completa
-            "default_action": {
-                "type": "web_url",
-                "url": product['default_action']['url'],
-                "webview_height_ratio": "tall",
-            },
-            "buttons": [
-                {
-                    "type": "web_url",
-                    "url": product['default_action']['url'],
-                    "title": "Ver Producto"
-                }
-            ]
+    # Los IDs ya vistos (en cualquier worker) se descartan al encolar
+    accepted = webhook_dispatcher.submit_delivery(jobs)
+    if accepted is None:
+        # Cola llena: no se guardó nada de la entrega, así Meta la reintenta completa
+        return 'Service Unavailable', 503
+    logger.debug("Entrega de WhatsApp con %d mensajes, %d nuevos", len(jobs), len(accepted))
+    return 'EVENT_RECEIVED', 200
+
+# Cliente HTTP saliente compartido (Graph API de WhatsApp y la tienda):
+# conexiones keep-alive por host, timeouts explícitos, reintentos con backoff
+# y jitter ante 429/5xx, un circuit breaker por servicio e histogramas de latencia.
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '15'))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+HTTP_BACKOFF_BASE = float(os.getenv('HTTP_BACKOFF_BASE', '0.25'))
+HTTP_BACKOFF_MAX = float(os.getenv('HTTP_BACKOFF_MAX', '5'))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    # Cerrado -> abierto tras N fallas seguidas; pasado el timeout deja pasar
+    # una prueba (semiabierto) y se cierra si sale bien.
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def release(self):
+        # La llamada terminó sin resultado (se canceló o se interrumpió): si
+        # era la prueba del semiabierto, la próxima llamada vuelve a probar
+        with self._lock:
+            self._probing = False
+
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            return 'half_open' if self._probing else 'open'
+
+def _request_not_sent(error):
+    # Errores en los que el pedido seguro no llegó al servidor
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+class UpstreamClient:
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        self.latency = {}
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'short_circuited': 0}
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    def session(self):
+        # Una sesión por worker: los sockets no se comparten entre procesos
+        if self._session_pid != os.getpid():
+            with self._lock:
+                if self._session_pid != os.getpid():
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def request(self, method, url, endpoint, idempotent=None, **kwargs):
+        # Los POST solo se reintentan si no llegaron al servidor (error de
+        # conexión) o ante un 429, para no enviar dos veces el mismo mensaje.
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        histogram = self.latency.get(endpoint)
+        if histogram is None:
+            histogram = self.latency.setdefault(endpoint, Histogram())
+
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            if not self.breaker.allow():
+                self.stats['short_circuited'] += 1
+                raise CircuitOpenError(f"Circuito abierto para {self.name}")
+            self.stats['requests'] += 1
+            started = time.monotonic()
+            retry_after = None
+            try:
+                response = self.session().request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                histogram.observe(time.monotonic() - started)
+                self.breaker.record_failure()
+                error = e
+                retryable = idempotent or _request_not_sent(e)
+            except Exception:
+                # Cualquier otro error (cuerpo cortado, URL inválida...) cuenta
+                # como falla y no se reintenta
+                histogram.observe(time.monotonic() - started)
+                self.breaker.record_failure()
+                self.stats['failures'] += 1
+                raise
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                histogram.observe(time.monotonic() - started)
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = None
+                retryable = idempotent or response.status_code == 429
+                retry_after = response.headers.get('Retry-After')
+
+            if not retryable or attempt == HTTP_MAX_RETRIES:
+                self.stats['failures'] += 1
+                if error is not None:
+                    raise error
+                return response
+            self.stats['retries'] += 1
+            if error is None:
+                # Con stream=True el cuerpo no se leyó; se libera la conexión
+                response.close()
+            time.sleep(self.backoff(attempt, retry_after))
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), HTTP_BACKOFF_MAX)
+        # Backoff exponencial con jitter completo
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+    def get(self, url, endpoint, **kwargs):
+        return self.request('GET', url, endpoint, **kwargs)
+
+    def post(self, url, endpoint, **kwargs):
+        return self.request('POST', url, endpoint, **kwargs)
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats['circuit'] = self.breaker.state()
+        stats['latency'] = {endpoint: h.snapshot() for endpoint, h in self.latency.items()}
+        return stats
+
+graph_api = UpstreamClient('graph_api')
+storefront = UpstreamClient('storefront')
+
+# Mensajes salientes de WhatsApp. Las partes fijas del JSON se serializan una
+# sola vez; el bloque "interactive" de cada lista de productos se guarda ya
+# serializado, así que un envío repetido solo concatena bytes. orjson se usa si
+# está instalado (bench/whatsapp_payload.py compara ambos codificadores).
+try:
+    import orjson
+except ImportError:  # orjson es opcional; sin él se usa json de la biblioteca estándar
+    orjson = None
+
+WHATSAPP_PAYLOAD_CACHE_SIZE = int(os.getenv('WHATSAPP_PAYLOAD_CACHE_SIZE', '512'))
+WHATSAPP_LIST_HEADER = "Productos Disponibles"
+WHATSAPP_LIST_BODY = "Selecciona un producto para obtener más información."
+WHATSAPP_LIST_BUTTON = "Ver Productos"
+WHATSAPP_LIST_SECTION = "Productos"
+WHATSAPP_ROW_BUTTON = "Ver Producto"
+
+def dumps_bytes(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return stdlib_json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+class WhatsAppPayloads:
+    def __init__(self, maxsize, dumps=dumps_bytes):
+        self.maxsize = maxsize
+        self.dumps = dumps
+        self._rendered = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+        self.headers = {
+            "Authorization": f"Bearer {ACCESS_TOKEN}",
+            "Content-Type": "application/json"
         }
-        for product in products
-    ]
-
-    data = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "interactive",
-        "interactive": {
+        self.url = f"{WHATSAPP_API_URL}/{PHONE_NUMBER_ID}/messages"
+        self._to = b'{"messaging_product":"whatsapp","to":'
+        self._text = b',"type":"text","text":{"body":'
+        self._interactive = b',"type":"interactive","interactive":'
+        # La plantilla de la lista se serializa con un marcador en lugar de
+        # las filas y se parte en dos, así el orden de las claves es el mismo
+        # que produciría el diccionario completo
+        marker = "\x00rows\x00"
+        template = self.dumps({
             "type": "list",
-            "header": {
-                "type": "text",
-                "text": "Productos Disponibles"
-            },
-            "body": {
-                "text": "Selecciona un producto para obtener más información."
-            },
+            "header": {"type": "text", "text": WHATSAPP_LIST_HEADER},
+            "body": {"text": WHATSAPP_LIST_BODY},
             "action": {
-                "button": "Ver Productos",
-                "sections": [
-                    {
-                        "title": "Productos",
-                        "rows": elements
-                    }
-                ]
+                "button": WHATSAPP_LIST_BUTTON,
+                "sections": [{"title": WHATSAPP_LIST_SECTION, "rows": marker}]
             }
-        }
-    }
+        })
+        self._list_head, self._list_tail = template.split(self.dumps(marker))
+
+    def _row(self, title, url):
+        url = self.dumps(url)
+        return b''.join((
+            b'{"title":', self.dumps(title),
+            b',"default_action":{"type":"web_url","url":', url,
+            b',"webview_height_ratio":"tall"},"buttons":[{"type":"web_url","url":', url,
+            b',"title":', self.dumps(WHATSAPP_ROW_BUTTON), b'}]}',
+        ))
+
+    def product_list(self, rows):
+        # rows: tupla de (título, url); devuelve el bloque "interactive" serializado
+        rows = tuple(rows)
+        with self._lock:
+            rendered = self._rendered.get(rows)
+            if rendered is not None:
+                self._rendered.move_to_end(rows)
+                self.stats['hits'] += 1
+                return rendered
+            self.stats['misses'] += 1
+        rendered = b''.join((self._list_head, b'[', b','.join(self._row(t, u) for t, u in rows), b']', self._list_tail))
+        with self._lock:
+            self._rendered[rows] = rendered
+            while len(self._rendered) > self.maxsize:
+                self._rendered.popitem(last=False)
+        return rendered
+
+    def text_message(self, to, body):
+        return b''.join((self._to, self.dumps(to), self._text, self.dumps(body), b'}}'))
+
+    def interactive_message(self, to, interactive):
+        return b''.join((self._to, self.dumps(to), self._interactive, interactive, b'}'))
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._rendered)
+        stats['encoder'] = 'orjson' if self.dumps is dumps_bytes and orjson is not None else 'json'
+        return stats
+
+whatsapp_payloads = WhatsAppPayloads(WHATSAPP_PAYLOAD_CACHE_SIZE)
+
+def whatsapp_product_list(product_name, productos):
+    # Igual que format_search_results, pero para WhatsApp: los productos pasan
+    # directo al bloque "interactive" ya serializado, sin armar el carrusel
+    if not productos:
+        return no_products_found(product_name)
+    rows = tuple((producto['titulo'], producto['link']) for producto in productos)
+    return {"whatsapp_list": whatsapp_payloads.product_list(rows)}
+
+@stage_metrics.instrument('whatsapp.send_message')
+def send_whatsapp_message(to, message):
+    # Asegurarse de que message sea una cadena
+    data = whatsapp_payloads.text_message(to, str(message))
+    response = graph_api.post(whatsapp_payloads.url, 'messages', headers=whatsapp_payloads.headers, data=data)
+    logger.debug("Mensaje enviado a %s (estado %s)", to, response.status_code)
+    return response.json()
 
-    response = requests.post(url, headers=headers, json=data)
-    print(f"Datos enviados: {data}")  # Depuración
-    print(f"Respuesta de la API: {response.json()}")  # Depuración
+@stage_metrics.instrument('whatsapp.send_carousel')
+def send_whatsapp_list(to, interactive):
+    data = whatsapp_payloads.interactive_message(to, interactive)
+    response = graph_api.post(whatsapp_payloads.url, 'messages', headers=whatsapp_payloads.headers, data=data)
+    logger.debug("Lista de productos enviada a %s (estado %s)", to, response.status_code)
     return response.json()
 
+def send_whatsapp_carousel(to, products):
+    # Recibe los elementos del carrusel de format_search_results
+    rows = tuple((product['title'], product['default_action']['url']) for product in products)
+    return send_whatsapp_list(to, whatsapp_payloads.product_list(rows))
+
+
 
+def chat_event_stream(user_id, user_input):
+    def generate():
+        for event, data in stream_user_input(user_id, user_input):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-@app.route('/chat', methods=['POST'])
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@bp.route('/chat', methods=['POST'])
 def chatbot():
     try:
-        # Recuperar o crear un user_id
-        user_id = request.cookies.get('user_id')
-        if not user_id:
-            user_id = str(uuid.uuid4())
-            response = make_response()
-            response.set_cookie('user_id', user_id, max_age=60*60*24*365*2)
-        else:
-            response = make_response()
+        # El user_id lo asigna ensure_user_id a partir de la cookie
+        user_id = web_conversation_key(session['user_id'])
 
         # Obtener el input del usuario desde el JSON de la solicitud
         user_input = request.json.get('input')
 
+        # Con Accept: text/event-stream la respuesta se envía token a token (SSE)
+        if request.accept_mimetypes.best == 'text/event-stream':
+            return chat_event_stream(user_id, user_input)
+
         # Procesar el input del usuario
         response_data = process_user_input(user_id, user_input)
 
-        # Verificar si la respuesta contiene la clave 'respuesta'
-        if 'respuesta' not in response_data:
+        # El widget espera 'response' o 'carousel'
+        if 'response' not in response_data and 'carousel' not in response_data:
             return 'Error: la respuesta no contiene la clave esperada.', 500
 
-        # Preparar la respuesta JSON
-        response_json = {
-            'respuesta': response_data['respuesta']
-        }
-
-        # Configurar la respuesta HTTP
-        response.data = json.dumps(response_json)
-        response.content_type = 'application/json'
-        return response
+        return jsonify(response_data)
     except KeyError as e:
-        print(f"KeyError: {e}")
+        logger.warning("Solicitud a /chat sin %s", e)
         return 'Error en la solicitud.', 400
-    except Exception as e:
-        print(f"Error procesando la solicitud: {e}")
+    except Exception:
+        logger.exception("Error procesando la solicitud")
         return 'Error procesando la solicitud.', 500
 
 
@@ -386,154 +1868,1300 @@ def get_initial_context():
         "Datos de Contacto: Teléfono: 03758 42-2637, Consultas: surcan.ventas@gmail.com"
     )
 
-def process_user_input(user_input):
-    if 'messages' not in session:
-        session['messages'] = []
-        session['has_greeted'] = True  # Estado de saludo
-
-    if not session['has_greeted']:
-        session['messages'].append({"role": "system", "content": "¡Hola! Soy tu asistente virtual. ¿En qué puedo ayudarte hoy?"})
-        session['has_greeted'] = True  # Marcar que se ha saludado
-
-    # Agregar contexto a la conversación
-    if len(session['messages']) == 1:  # Solo agregar el contexto si es la primera interacción después del saludo
-        context = get_initial_context()
-        session['messages'].append({"role": "system", "content": context})
-
-    # Imprimir el mensaje del usuario para depuración
-    print(f"Mensaje del usuario: {user_input}")
-
-    session['messages'].append({"role": "user", "content": user_input})
-
+# Ventana de contexto para OpenAI: el prompt del sistema va una sola vez, los
+# turnos recientes entran mientras alcance el presupuesto de tokens y los más
+# viejos se resumen en un mensaje que se guarda en caché por usuario.
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))
+SUMMARY_MAX_TOKENS = int(os.getenv('SUMMARY_MAX_TOKENS', '200'))
+SUMMARY_CACHE_SIZE = int(os.getenv('SUMMARY_CACHE_SIZE', '1000'))
+# Mensajes fuera de la ventana que se juntan antes de actualizar el resumen
+SUMMARY_BATCH_MESSAGES = int(os.getenv('SUMMARY_BATCH_MESSAGES', '6'))
+
+try:
+    import tiktoken
+    _token_encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+except Exception:  # tiktoken es opcional; sin él se estima ~4 caracteres por token
+    _token_encoding = None
+
+def count_tokens(text):
+    if _token_encoding is not None:
+        return len(_token_encoding.encode(text))
+    return (len(text) + 3) // 4
+
+def count_message_tokens(message):
+    # Cada mensaje del chat suma ~4 tokens de formato además del contenido
+    return count_tokens(message['content']) + 4
+
+@lru_cache(maxsize=1)
+def system_prompt_message():
+    message = {"role": "system", "content": get_initial_context()}
+    return message, count_message_tokens(message)
+
+class OpenAIStats:
+    # Uso de OpenAI (llamadas, tokens, latencia); lo comparten el modo WSGI y el ASGI
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'errors': 0, 'prompt_tokens': 0, 'completion_tokens': 0,
+                      'latency_seconds_total': 0.0, 'latency_seconds_max': 0.0,
+                      'last_prompt_tokens': 0, 'last_completion_tokens': 0,
+                      'streams': 0, 'first_token_seconds_total': 0.0}
+
+    def record_call(self, prompt_tokens, completion_tokens, elapsed):
+        with self._lock:
+            self.stats['calls'] += 1
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['completion_tokens'] += completion_tokens
+            self.stats['last_prompt_tokens'] = prompt_tokens
+            self.stats['last_completion_tokens'] = completion_tokens
+            self.stats['latency_seconds_total'] += elapsed
+            self.stats['latency_seconds_max'] = max(self.stats['latency_seconds_max'], elapsed)
+        logger.debug("OpenAI: %d tokens de prompt, %d de respuesta, %.2fs", prompt_tokens, completion_tokens, elapsed)
+
+    def record_first_token(self, elapsed):
+        with self._lock:
+            self.stats['streams'] += 1
+            self.stats['first_token_seconds_total'] += elapsed
+
+    def record_error(self):
+        with self._lock:
+            self.stats['errors'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats)
+
+openai_stats = OpenAIStats()
+
+def estimate_prompt_tokens(messages):
+    # La API no informa el uso en modo stream: se estima con el mismo conteo del presupuesto
+    return sum(count_message_tokens(m) for m in messages) + 3
+
+@stage_metrics.instrument('openai.chat')
+def chat_completion(messages, **kwargs):
+    # Llamada a OpenAI con métricas de tokens y latencia por llamada
+    started = time.monotonic()
     try:
-        if is_product_search_intent(user_input):
-            product_name = extract_product_name(user_input)
-            print(f"Nombre del producto extraído: {product_name}")  # Verificar nombre del producto
-            bot_message = search_product_on_surcansa(product_name)
-            print(f"Mensaje del bot después de búsqueda: {bot_message}")  # Verificar el mensaje del bot
-
-            # Verificar que el formato de la respuesta sea el esperado
-            if 'carousel' in bot_message:
-                return bot_message
-            else:
-                return {"response": bot_message.get('response', "No se encontraron productos.")}
+        response = get_openai().ChatCompletion.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            **kwargs
+        )
+    except Exception:
+        openai_stats.record_error()
+        raise
+    elapsed = time.monotonic() - started
+    usage = response.get('usage') or {}
+    openai_stats.record_call(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), elapsed)
+    return response
 
+@stage_metrics.instrument('openai.chat_stream')
+def chat_completion_stream(messages, **kwargs):
+    # Igual que chat_completion pero entrega el texto a medida que llega. La API
+    # no informa el uso en modo stream, así que los tokens se estiman.
+    started = time.monotonic()
+    parts = []
+    try:
+        for chunk in get_openai().ChatCompletion.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            stream=True,
+            **kwargs
+        ):
+            delta = chunk.choices[0].delta.get('content')
+            if delta:
+                if not parts:
+                    openai_stats.record_first_token(time.monotonic() - started)
+                parts.append(delta)
+                yield delta
+    except Exception:
+        openai_stats.record_error()
+        raise
+    openai_stats.record_call(estimate_prompt_tokens(messages), count_tokens(''.join(parts)), time.monotonic() - started)
+
+def _message_key(message):
+    return hashlib.sha1(f"{message['role']}:{message['content']}".encode('utf-8')).hexdigest()
+
+class ContextWindow:
+    # El resumen nunca se arma en medio de una respuesta: build usa el que ya
+    # está guardado y los turnos que quedaron afuera se pliegan en segundo
+    # plano cuando se juntan batch_messages (o enseguida si todavía no hay
+    # resumen), así una conversación larga no paga una llamada extra por turno.
+    def __init__(self, budget, summary_max_tokens, cache_size, batch_messages):
+        self.budget = budget
+        self.summary_max_tokens = summary_max_tokens
+        self.cache_size = cache_size
+        self.batch_messages = batch_messages
+        # user_id -> (clave del último mensaje resumido, texto del resumen)
+        self._summaries = OrderedDict()
+        # user_id -> marca del resumen en curso; reset la quita para descartarlo
+        self._in_progress = {}
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self.stats = {'trimmed_messages': 0, 'duplicates_dropped': 0, 'summaries': 0, 'summary_errors': 0,
+                      'summaries_scheduled': 0}
+
+    @stage_metrics.instrument('context_window.build')
+    def build(self, user_id, history, user_input):
+        system_message, system_tokens = system_prompt_message()
+        user_message = {"role": "user", "content": user_input}
+
+        # Descartar mensajes repetidos consecutivos
+        deduped = []
+        for message in history:
+            if deduped and deduped[-1] == message:
+                self.stats['duplicates_dropped'] += 1
+                continue
+            deduped.append(message)
+
+        # Los turnos más recientes que entran en el presupuesto se envían tal cual
+        available = self.budget - system_tokens - count_message_tokens(user_message) - self.summary_max_tokens - 3
+        recent = []
+        for message in reversed(deduped):
+            cost = count_message_tokens(message)
+            if cost > available:
+                break
+            recent.insert(0, message)
+            available -= cost
+        older = deduped[:len(deduped) - len(recent)]
+
+        messages = [system_message]
+        if older:
+            self.stats['trimmed_messages'] += len(older)
+            summary = self._summary(user_id, older)
+            if summary:
+                messages.append({"role": "system", "content": f"Resumen de la conversación previa: {summary}"})
+        return messages + recent + [user_message]
+
+    def _summary(self, user_id, older):
+        # Devuelve el resumen guardado y, si corresponde, programa el siguiente
+        with self._lock:
+            cached_key, summary = self._summaries.get(user_id, (None, ''))
+        keys = [_message_key(m) for m in older]
+        if cached_key in keys:
+            pending = older[keys.index(cached_key) + 1:]
         else:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=session['messages'],
-                temperature=0.01  # Ajusta la temperatura aquí
-            )
-            bot_message = {"response": response.choices[0].message['content'].strip()}
-            session['messages'].append({"role": "assistant", "content": bot_message['response']})
-
-        # Verificar y asegurar la clave 'response' en la respuesta del bot
-        if 'response' not in bot_message:
-            bot_message['response'] = "Lo siento, no entendí tu solicitud."
-
-        # Agregar la respuesta del bot a la sesión
-        session['messages'].append({"role": "assistant", "content": bot_message['response']})
-
-        # Imprimir la respuesta del chatbot y el estado de la sesión
-        print(f"Respuesta del chatbot: {bot_message}")
-        print(f"Estado de la sesión: {session}")
-
+            pending = older
+        if pending and (not summary or len(pending) >= self.batch_messages):
+            self._schedule(user_id, summary, pending, keys[-1])
+        return summary
+
+    def _schedule(self, user_id, summary, pending, last_key):
+        with self._lock:
+            if user_id in self._in_progress:
+                return
+            token = self._in_progress[user_id] = object()
+            # Un pool por worker de gunicorn, creado después del fork
+            if self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix='summary')
+                self._executor_pid = os.getpid()
+            executor = self._executor
+        self.stats['summaries_scheduled'] += 1
+        executor.submit(self._summarize, user_id, token, summary, pending, last_key)
+
+    def _summarize(self, user_id, token, summary, pending, last_key):
+        # Resumen incremental: el resumen anterior más los turnos nuevos a plegar
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in pending)
+        prompt = [
+            {"role": "system", "content": "Resume en español, en pocas oraciones, la conversación entre un cliente "
+                                          "y el asistente de Surcan. Conserva productos, datos y pedidos mencionados."},
+            {"role": "user", "content": f"Resumen previo: {summary or '(ninguno)'}\n\nNuevos mensajes:\n{transcript}"},
+        ]
+        try:
+            response = chat_completion(prompt, temperature=0, max_tokens=self.summary_max_tokens)
+            summary = response.choices[0].message['content'].strip()
+            self.stats['summaries'] += 1
+        except Exception as e:
+            # Sin resumen nuevo se conserva el anterior y se reintenta en el próximo turno
+            logger.warning("Error resumiendo la conversación de %s: %s", user_id, e)
+            self.stats['summary_errors'] += 1
+            summary = None
+        with self._lock:
+            if self._in_progress.get(user_id) is not token:
+                return  # reset durante el resumen
+            del self._in_progress[user_id]
+            if summary is None:
+                return
+            self._summaries[user_id] = (last_key, summary)
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.cache_size:
+                self._summaries.popitem(last=False)
+
+    def reset(self, user_id):
+        # Tras /reset el resumen de la conversación anterior no debe volver al contexto
+        with self._lock:
+            self._summaries.pop(user_id, None)
+            self._in_progress.pop(user_id, None)
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats['budget'] = self.budget
+        stats['cached_summaries'] = len(self._summaries)
+        return stats
+
+context_window = ContextWindow(CONTEXT_TOKEN_BUDGET, SUMMARY_MAX_TOKENS, SUMMARY_CACHE_SIZE, SUMMARY_BATCH_MESSAGES)
+
+# Caché semántica de respuestas frecuentes (horarios, envíos, devoluciones...).
+# Una pregunta nueva se compara por similitud coseno contra las ya respondidas
+# usando los vectores de es_core_news_md; si supera el umbral no se llama a OpenAI.
+FAQ_CACHE_THRESHOLD = float(os.getenv('FAQ_CACHE_THRESHOLD', '0.92'))
+FAQ_CACHE_TTL = float(os.getenv('FAQ_CACHE_TTL', '86400'))
+FAQ_CACHE_SIZE = int(os.getenv('FAQ_CACHE_SIZE', '512'))
+
+class SemanticAnswerCache:
+    # Los vectores viven en una matriz preasignada (una fila por pregunta) que
+    # se actualiza al guardar, así cada búsqueda es un solo producto matriz-vector.
+    # Cada fila lleva además el id de sus QUESTION_QUALIFIERS y solo compiten
+    # las filas con el mismo conjunto que la pregunta.
+    def __init__(self, threshold, ttl, maxsize):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # pregunta normalizada -> fila de la matriz
+        self._entries = OrderedDict()
+        self._row_keys = [None] * maxsize
+        self._answers = [None] * maxsize
+        self._free_rows = list(range(maxsize - 1, -1, -1))
+        self._matrix = None  # se crea con la dimensión del primer vector
+        self._stored_at = None
+        self._row_qualifiers = None
+        self._qualifier_ids = {}  # frozenset de calificadores -> id
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0, 'skipped_personal': 0}
+
+    def _release(self, row):
+        del self._entries[self._row_keys[row]]
+        self._row_keys[row] = self._answers[row] = None
+        self._stored_at[row] = -numpy_module().inf
+        self._free_rows.append(row)
+
+    @stage_metrics.instrument('faq_cache.lookup')
+    def lookup(self, user_input):
+        vector = question_vector(user_input)
+        if vector is None:
+            self.stats['misses'] += 1
+            return None
+        qualifiers = question_qualifiers(user_input)
+        numpy = numpy_module()
+        now = time.monotonic()
+        with self._lock:
+            qualifier_id = self._qualifier_ids.get(qualifiers)
+            if not self._entries or qualifier_id is None:
+                self.stats['misses'] += 1
+                return None
+            # Las filas libres tienen stored_at = -inf y quedan como vencidas
+            expired = now - self._stored_at > self.ttl
+            for row in numpy.flatnonzero(expired & (self._stored_at > -numpy.inf)):
+                self._release(int(row))
+                self.stats['expired'] += 1
+            similarities = self._matrix @ vector
+            similarities[expired | (self._row_qualifiers != qualifier_id)] = -numpy.inf
+            best = int(numpy.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(self._row_keys[best])
+            self.stats['hits'] += 1
+            logger.debug("Respuesta en caché (similitud %.3f) para: %s", similarities[best], user_input)
+            return self._answers[best]
+
+    def store(self, user_input, answer):
+        vector = question_vector(user_input)
+        if vector is None or not self.maxsize:
+            return
+        # Respuestas con datos de una persona (nombres, números de pedido,
+        # correos) no se comparten con otros usuarios
+        if is_personal_question(user_input):
+            self.stats['skipped_personal'] += 1
+            return
+        key = normalize_user_input(user_input)
+        qualifiers = question_qualifiers(user_input)
+        with self._lock:
+            if self._matrix is None:
+                numpy = numpy_module()
+                self._matrix = numpy.zeros((self.maxsize, len(vector)), dtype=vector.dtype)
+                self._stored_at = numpy.full(self.maxsize, -numpy.inf)
+                self._row_qualifiers = numpy.full(self.maxsize, -1)
+            row = self._entries.get(key)
+            if row is None:
+                if self._free_rows:
+                    row = self._free_rows.pop()
+                else:
+                    _, row = self._entries.popitem(last=False)
+                    self.stats['evictions'] += 1
+                self._entries[key] = row
+            self._entries.move_to_end(key)
+            self._matrix[row] = vector
+            self._stored_at[row] = time.monotonic()
+            self._row_qualifiers[row] = self._qualifier_ids.setdefault(qualifiers, len(self._qualifier_ids))
+            self._row_keys[row] = key
+            self._answers[row] = answer
+            self.stats['stores'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['threshold'] = self.threshold
+        return stats
+
+faq_cache = SemanticAnswerCache(FAQ_CACHE_THRESHOLD, FAQ_CACHE_TTL, FAQ_CACHE_SIZE)
+
+# Pasos comunes de process_user_input, stream_user_input y asgi.chat_events
+
+def begin_turn(user_id, user_input):
+    # Guarda el mensaje del usuario y devuelve el historial previo
+    logger.debug("Mensaje del usuario: %s", user_input)
+    history = conversation_store.history(user_id)
+    conversation_store.append(user_id, "user", user_input)
+    return history
+
+def search_reply(bot_message):
+    # Verificar que el formato de la respuesta sea el esperado: la lista de
+    # productos tal cual o el texto de la respuesta
+    if 'carousel' in bot_message or 'whatsapp_list' in bot_message:
         return bot_message
-    except Exception as e:
-        print(f"Error processing input: {str(e)}")
+    return {"response": bot_message.get('response', "No se encontraron productos.")}
+
+def cached_reply(user_input, history):
+    # Con turnos previos la pregunta puede depender de la conversación
+    # ("¿y el de 50 kg?"), así que no se responde desde la caché
+    if history:
+        return None
+    return faq_cache.lookup(user_input)
+
+def answer_question(user_id, history, user_input):
+    # El contexto de Surcan no se guarda en el historial: se antepone en cada llamada
+    messages = context_window.build(user_id, history, user_input)
+    response = chat_completion(
+        messages,
+        temperature=0.01  # Ajusta la temperatura aquí
+    )
+    return response.choices[0].message['content'].strip()
+
+def finish_turn(user_id, user_input, reply, cacheable=False):
+    # Guarda la respuesta del bot en el historial (y en la caché de
+    # respuestas frecuentes si no dependía de turnos previos)
+    reply = reply or "Lo siento, no entendí tu solicitud."
+    if cacheable:
+        faq_cache.store(user_input, reply)
+    conversation_store.append(user_id, "assistant", reply)
+    logger.debug("Respuesta del chatbot: %s", reply)
+    return reply
+
+@stage_metrics.instrument('process_user_input')
+def process_user_input(user_id, user_input, render_products=None):
+    history = begin_turn(user_id, user_input)
+    try:
+        is_search, product_name = analyze_user_input(user_input)
+        if is_search:
+            logger.debug("Nombre del producto extraído: %s", product_name)
+            return search_reply(search_product_on_surcansa(product_name, render=render_products))
+
+        reply = cached_reply(user_input, history)
+        if reply is not None:
+            return {"response": finish_turn(user_id, user_input, reply)}
+        if history:
+            reply = answer_question(user_id, history, user_input)
+        else:
+            # Sin turnos previos la respuesta depende solo de la pregunta:
+            # las preguntas iguales en curso comparten la llamada a OpenAI
+            reply = faq_flight.do(normalize_user_input(user_input),
+                                  lambda: answer_question(user_id, history, user_input))
+        return {"response": finish_turn(user_id, user_input, reply, cacheable=not history)}
+    except Exception:
+        logger.exception("Error procesando el mensaje")
         return {"response": "Lo siento, hubo un problema al procesar tu solicitud."}
 
-def is_product_search_intent(user_input):
-    # Analiza el texto del usuario
-    doc = nlp(user_input.lower())
-    # Busca patrones en la frase que indiquen una intención de búsqueda
-    for token in doc:
-        if token.lemma_ in ["buscar", "necesitar", "querer"] and token.pos_ == "VERB":
-            return True
-    return False
-
-def extract_product_name(user_input):
-    # Analiza el texto del usuario
-    doc = nlp(user_input.lower())
+@stage_metrics.instrument('stream_user_input')
+def stream_user_input(user_id, user_input):
+    # Variante de process_user_input para /chat con text/event-stream: produce
+    # pares (evento, datos) y guarda la respuesta completa al terminar.
+    history = begin_turn(user_id, user_input)
+    try:
+        is_search, product_name = analyze_user_input(user_input)
+        if is_search:
+            bot_message = search_reply(search_product_on_surcansa(product_name))
+            yield ('carousel' if 'carousel' in bot_message else 'response'), bot_message
+            return
+
+        reply = cached_reply(user_input, history)
+        cacheable = False
+        if reply is None:
+            messages = context_window.build(user_id, history, user_input)
+            parts = []
+            for delta in chat_completion_stream(messages, temperature=0.01):
+                parts.append(delta)
+                yield 'token', {"delta": delta}
+            reply, cacheable = "".join(parts).strip(), not history
+        yield 'done', {"response": finish_turn(user_id, user_input, reply, cacheable)}
+    except Exception:
+        logger.exception("Error procesando el mensaje")
+        yield 'error', {"response": "Lo siento, hubo un problema al procesar tu solicitud."}
+
+SEARCH_VERBS = ("buscar", "necesitar", "querer")
+PERSONAL_MARKERS = {"mi", "mis", "mío", "mía", "míos", "mías", "soy", "llamo"}
+# Negaciones, interrogativos y referencias de tiempo. spaCy los trata como
+# stopwords y no entran en el vector, pero cambian la respuesta ("¿hacen envíos
+# los sábados?" / "¿no hacen envíos los sábados?"): la caché de respuestas
+# solo acierta si ambas preguntas tienen los mismos (sin tildes).
+QUESTION_QUALIFIERS = {
+    "no", "ni", "sin", "nunca", "jamas", "tampoco", "nada", "nadie", "ningun", "ninguno", "ninguna",
+    "donde", "adonde", "cuando", "cuanto", "cuanta", "cuantos", "cuantas", "como", "cual", "cuales",
+    "quien", "quienes", "hasta", "desde", "antes", "despues", "hoy", "manana", "ayer", "siempre",
+    "todavia", "aun", "ya",
+}
+NLP_CACHE_SIZE = int(os.getenv('NLP_CACHE_SIZE', '1024'))
+NLP_BATCH_SIZE = int(os.getenv('NLP_BATCH_SIZE', '64'))
+
+def normalize_user_input(user_input):
+    return " ".join(user_input.lower().split())
+
+def _analyze_doc(doc):
+    # Un único pase de spaCy para la intención, el nombre del producto y el
+    # vector de la pregunta (usado por la caché de respuestas frecuentes)
     product_name = []
     is_searching = False
+    personal = False
+    qualifiers = set()
+    content_vectors = []
     for token in doc:
         # Detectar la frase de búsqueda
-        if token.lemma_ in ["buscar", "necesitar", "querer"] and token.pos_ == "VERB":
+        if token.lemma_ in SEARCH_VERBS and token.pos_ == "VERB":
             is_searching = True
         # Extraer sustantivos después del verbo de búsqueda
         if is_searching and token.pos_ in ["NOUN", "PROPN"]:
             product_name.append(token.text)
-    return " ".join(product_name)
+        if token.has_vector and not token.is_stop and not token.is_punct:
+            content_vectors.append(token.vector)
+        # Nombres, números (pedidos, teléfonos), correos o "mi"/"soy": la
+        # respuesta puede ser de esa persona y no va a la caché compartida
+        if (token.pos_ == "PROPN" or token.like_num or token.like_email or token.like_url
+                or token.text in PERSONAL_MARKERS or any(c.isdigit() for c in token.text)):
+            personal = True
+        word = _strip_accents(token.lower_)
+        if word in QUESTION_QUALIFIERS:
+            qualifiers.add(word)
+    return is_searching, " ".join(product_name), _unit_vector(content_vectors), personal, frozenset(qualifiers)
+
+def _strip_accents(text):
+    return ''.join(c for c in unicodedata.normalize('NFD', text) if not unicodedata.combining(c))
+
+class AnalysisCache:
+    # Resultados de _analyze_doc por texto normalizado (LRU). analyze_many
+    # pasa todos los textos que faltan por nlp.pipe en un solo lote.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'batches': 0, 'batched_texts': 0}
+
+    def _get(self, text):
+        with self._lock:
+            result = self._data.get(text)
+            if result is None:
+                self.stats['misses'] += 1
+            else:
+                self._data.move_to_end(text)
+                self.stats['hits'] += 1
+            return result
+
+    def _put(self, text, result):
+        with self._lock:
+            self._data[text] = result
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def analyze(self, text):
+        result = self._get(text)
+        if result is None:
+            result = _analyze_doc(get_nlp()(text))
+            self._put(text, result)
+        return result
+
+    def analyze_many(self, texts):
+        results = {text: self._get(text) for text in dict.fromkeys(texts)}
+        missing = [text for text, result in results.items() if result is None]
+        if missing:
+            for text, doc in zip(missing, get_nlp().pipe(missing, batch_size=NLP_BATCH_SIZE)):
+                results[text] = _analyze_doc(doc)
+                self._put(text, results[text])
+            self.stats['batches'] += 1
+            self.stats['batched_texts'] += len(missing)
+        return [results[text] for text in texts]
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._data)
+        stats['max_size'] = self.maxsize
+        return stats
+
+analysis_cache = AnalysisCache(NLP_CACHE_SIZE)
+
+def numpy_module():
+    import numpy
+    return numpy
+
+def _unit_vector(vectors):
+    if not vectors:
+        return None
+    numpy = numpy_module()
+    vector = numpy.mean(vectors, axis=0)
+    norm = numpy.linalg.norm(vector)
+    return vector / norm if norm else None
+
+@stage_metrics.instrument('nlp.analyze')
+def analyze_user_input(user_input):
+    # Devuelve (es_busqueda_de_producto, nombre_del_producto)
+    return analysis_cache.analyze(normalize_user_input(user_input))[:2]
+
+def question_vector(user_input):
+    # Vector normalizado de las palabras con contenido (sin stopwords); None si no hay
+    return analysis_cache.analyze(normalize_user_input(user_input))[2]
+
+def is_personal_question(user_input):
+    return analysis_cache.analyze(normalize_user_input(user_input))[3]
+
+def question_qualifiers(user_input):
+    # Negaciones e interrogativos de la pregunta (ver QUESTION_QUALIFIERS)
+    return analysis_cache.analyze(normalize_user_input(user_input))[4]
+
+@stage_metrics.instrument('nlp.analyze_many')
+def analyze_many(user_inputs):
+    # Como analyze_user_input para varios mensajes, con un solo nlp.pipe
+    return [result[:2] for result in analysis_cache.analyze_many([normalize_user_input(text) for text in user_inputs])]
+
+def nlp_cache_stats():
+    return analysis_cache.snapshot()
 
-def search_product_on_surcansa(product_name):
-    search_url = f'https://surcansa.com.ar/search?q={product_name}'
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-    
+def is_product_search_intent(user_input):
+    return analyze_user_input(user_input)[0]
+
+def extract_product_name(user_input):
+    return analyze_user_input(user_input)[1]
+
+# Caché de resultados de búsqueda del catálogo
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL', '300'))
+# Pasado el TTL se sigue respondiendo con el resultado viejo (y se refresca en
+# segundo plano) hasta este margen; después la búsqueda vuelve a ser bloqueante.
+SEARCH_CACHE_MAX_STALE = float(os.getenv('SEARCH_CACHE_MAX_STALE', '3600'))
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '512'))
+SEARCH_RESULT_LIMIT = 5
+
+CACHE_MISS = object()
+
+class StaleWhileRevalidateCache:
+    # LRU acotado con TTL. Las entradas vencidas se devuelven igual mientras
+    # un hilo en segundo plano las recarga (stale-while-revalidate).
+    def __init__(self, ttl, max_stale, maxsize):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0,
+                      'refresh_errors': 0, 'evictions': 0}
+
+    def get_or_load(self, key, loader):
+        value = self.lookup(key, loader)
+        if value is CACHE_MISS:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def lookup(self, key, loader):
+        # Devuelve el valor en caché (programando la recarga si está vencido)
+        # o CACHE_MISS; así el modo ASGI puede cargar el valor de forma asíncrona.
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                age = now - stored_at
+                if age <= self.ttl:
+                    self._data.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return value
+                if age <= self.ttl + self.max_stale:
+                    self._data.move_to_end(key)
+                    self.stats['stale_hits'] += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                    return value
+            self.stats['misses'] += 1
+        return CACHE_MISS
+
+    def _refresh(self, key, loader):
+        try:
+            self.set(key, loader())
+            with self._lock:
+                self.stats['refreshes'] += 1
+        except Exception as e:
+            logger.warning("Error refrescando la caché para '%s': %s", key, e)
+            with self._lock:
+                self.stats['refresh_errors'] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['size'] = len(self._data)
+        stats['max_size'] = self.maxsize
+        return stats
+
+search_cache = StaleWhileRevalidateCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_STALE, SEARCH_CACHE_SIZE)
+
+# Coalescencia de solicitudes (single-flight). Cuando sale una promo llegan
+# decenas de "necesito cemento" en pocos segundos: las llamadas idénticas que
+# se superponen comparten una sola consulta a la tienda (o a OpenAI) y todas
+# reciben su resultado. Dentro del worker alcanza con las llamadas en curso;
+# con SINGLE_FLIGHT_DB_PATH también se coordinan los workers de la máquina.
+SINGLE_FLIGHT_DB_PATH = os.getenv('SINGLE_FLIGHT_DB_PATH')  # sin definir: solo dentro de cada worker
+SINGLE_FLIGHT_WAIT = float(os.getenv('SINGLE_FLIGHT_WAIT', '30'))
+SINGLE_FLIGHT_RESULT_TTL = float(os.getenv('SINGLE_FLIGHT_RESULT_TTL', '10'))
+SINGLE_FLIGHT_POLL_INTERVAL = 0.02
+
+class SharedFlightStore:
+    # Un lock de rango de bytes (fcntl.lockf) por clave sobre un archivo
+    # compartido elige qué worker hace la llamada; el resultado queda unos
+    # segundos en SQLite para los workers que esperaban. Los locks de rango son
+    # por proceso, así que cada worker abre su propio descriptor después del fork.
+    # Dentro del proceso lockf nunca bloquea a otro hilo o corrutina y un solo
+    # unlock libera el rango para todos: _held registra qué rangos tiene tomados
+    # el proceso, y SingleFlight y asgi.AsyncSingleFlight pasan los dos por acá.
+    def __init__(self, path, wait, result_ttl):
+        self.path = path
+        self.wait = wait
+        self.result_ttl = result_ttl
+        self._local = threading.local()
+        self._lock_file = None
+        self._lock_file_pid = None
+        self._lock_file_lock = threading.Lock()
+        self._held = set()  # offsets tomados por este proceso
+        self._held_lock = threading.Lock()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS flight_results (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    stored_at REAL NOT NULL
+                )
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def _locks(self):
+        with self._lock_file_lock:
+            if self._lock_file_pid != os.getpid():
+                self._lock_file = open(self.path + '.lock', 'a+b')
+                self._lock_file_pid = os.getpid()
+                # Los rangos que tenía el padre no pasan al hijo con el fork
+                self._held = set()
+            return self._lock_file
+
+    def result(self, key):
+        try:
+            row = self._conn().execute(
+                'SELECT value FROM flight_results WHERE key = ? AND stored_at >= ?',
+                (key, time.time() - self.result_ttl)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Error leyendo el resultado compartido de '%s': %s", key, e)
+            return CACHE_MISS
+        return stdlib_json.loads(row[0]) if row else CACHE_MISS
+
+    def store(self, key, value):
+        now = time.time()
+        try:
+            with self._conn() as conn:
+                conn.execute('DELETE FROM flight_results WHERE stored_at < ?', (now - self.result_ttl,))
+                conn.execute('INSERT OR REPLACE INTO flight_results (key, value, stored_at) VALUES (?, ?, ?)',
+                             (key, stdlib_json.dumps(value, ensure_ascii=False), now))
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logger.warning("Error guardando el resultado compartido de '%s': %s", key, e)
+
+    def _offset(self, key):
+        return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:4], 'big')
+
+    def acquire(self, key):
+        # No bloquea: True si quien llama quedó a cargo de la clave, False si
+        # la tiene otro hilo, corrutina o worker y None si no se puede abrir
+        # el archivo de locks
+        try:
+            lock_file = self._locks()
+        except OSError as e:
+            logger.warning("No se pudo abrir %s.lock: %s", self.path, e)
+            return None
+        offset = self._offset(key)
+        with self._held_lock:
+            if offset in self._held:
+                return False
+            try:
+                fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            except OSError:
+                return False
+            self._held.add(offset)
+        return True
+
+    def release(self, key):
+        offset = self._offset(key)
+        with self._held_lock:
+            fcntl.lockf(self._locks(), fcntl.LOCK_UN, 1, offset)
+            self._held.discard(offset)
+
+    def run(self, key, fn):
+        # Devuelve (valor, resultado) con resultado 'executions' si la llamada
+        # se hizo acá, 'shared' si la hizo otro worker o 'shared_timeouts' si
+        # se dejó de esperar al otro worker y se hizo igual. La versión para el
+        # event loop (asgi.AsyncSingleFlight) repite estos pasos sin bloquear.
+        value = self.result(key)
+        if value is not CACHE_MISS:
+            return value, 'shared'
+        deadline = time.monotonic() + self.wait
+        while True:
+            acquired = self.acquire(key)
+            if acquired is None:
+                return fn(), 'executions'
+            if acquired:
+                break
+            if time.monotonic() >= deadline:
+                logger.warning("Venció la espera del resultado compartido de '%s'", key)
+                return fn(), 'shared_timeouts'
+            time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            value = self.result(key)
+            if value is not CACHE_MISS:
+                return value, 'shared'
+        try:
+            # Otro worker pudo terminar entre la primera lectura y el lock
+            value = self.result(key)
+            if value is not CACHE_MISS:
+                return value, 'shared'
+            value = fn()
+            self.store(key, value)
+            return value, 'executions'
+        finally:
+            self.release(key)
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class SingleFlight:
+    def __init__(self, name, shared=None):
+        self.name = name
+        self.shared = shared
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'executions': 0, 'coalesced': 0, 'shared': 0,
+                      'shared_timeouts': 0, 'errors': 0}
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self.record('calls', 'coalesced')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            if self.shared is None:
+                flight.value, outcome = fn(), 'executions'
+            else:
+                flight.value, outcome = self.shared.run(f"{self.name}:{key}", fn)
+            self.record('calls', outcome)
+            return flight.value
+        except Exception as e:
+            # Los que esperaban reciben el mismo error
+            flight.error = e
+            self.record('calls', 'errors')
+            raise
+        finally:
+            # Se quita antes de avisar, así una llamada posterior vuelve a consultar
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def record(self, *counters):
+        with self._lock:
+            for counter in counters:
+                self.stats[counter] += 1
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = len(self._flights)
+        saved = stats['coalesced'] + stats['shared']
+        stats['coalescing_ratio'] = round(saved / stats['calls'], 4) if stats['calls'] else 0.0
+        stats['cross_worker'] = self.shared is not None
+        return stats
+
+single_flight_store = (SharedFlightStore(SINGLE_FLIGHT_DB_PATH, SINGLE_FLIGHT_WAIT, SINGLE_FLIGHT_RESULT_TTL)
+                       if SINGLE_FLIGHT_DB_PATH else None)
+search_flight = SingleFlight('search', single_flight_store)
+faq_flight = SingleFlight('faq', single_flight_store)
+
+def single_flight_stats():
+    return {'search': search_flight.snapshot(), 'faq': faq_flight.snapshot()}
+
+SURCANSA_BASE_URL = os.getenv('SURCANSA_BASE_URL', "https://surcansa.com.ar")
+SURCANSA_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+# Parser de la grilla de productos. En lugar de armar el árbol completo de la
+# página con BeautifulSoup, recorre el HTML de a pedazos con HTMLParser y solo
+# guarda lo que hay dentro de los <li class="grid__item">: la primera imagen, el
+# enlace .full-unstyled-link y el precio .price-item--regular. Con un límite
+# deja de leer apenas completó esa cantidad de productos.
+SEARCH_PARSE_CHUNK = int(os.getenv('SEARCH_PARSE_CHUNK', '16384'))
+
+
+class _GridComplete(Exception):
+    pass
+
+
+def _html_classes(attrs):
+    for name, value in attrs:
+        if name == 'class' and value:
+            return value.split()
+    return ()
+
+
+class ProductGridParser(HTMLParser):
+    def __init__(self, limit=None, base_url=SURCANSA_BASE_URL):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.base_url = base_url
+        self.products = []
+        self._item = None
+        self._li_depth = 0
+        self._captures = {}  # campo -> [tag, profundidad, textos]
+        self._pending = []
+
+    def _flush_text(self):
+        # Igual que get_text(strip=True): cada nodo de texto se recorta por
+        # separado y se concatenan sin separador.
+        if self._pending:
+            text = ''.join(self._pending).strip()
+            self._pending = []
+            if text:
+                for capture in self._captures.values():
+                    capture[2].append(text)
+
+    def handle_starttag(self, tag, attrs):
+        self._flush_text()
+        if self._item is None:
+            if tag == 'li' and 'grid__item' in _html_classes(attrs):
+                self._item = {}
+                self._li_depth = 1
+            return
+
+        for capture in self._captures.values():
+            if capture[0] == tag:
+                capture[1] += 1
+        if tag == 'li':
+            self._li_depth += 1
+        elif tag == 'img':
+            if 'imagen' not in self._item:
+                self._item['imagen'] = dict(attrs).get('src', 'No image')
+        elif tag == 'a':
+            if 'titulo' not in self._item and 'full-unstyled-link' in _html_classes(attrs):
+                href = dict(attrs).get('href') or ''
+                self._item['link'] = f"{self.base_url}{href}" if href.startswith('/') else href
+                self._item['titulo'] = ''
+                self._captures['titulo'] = [tag, 1, []]
+        elif tag == 'span':
+            if 'precio' not in self._item and 'price-item--regular' in _html_classes(attrs):
+                self._item['precio'] = ''
+                self._captures['precio'] = [tag, 1, []]
+
+    def handle_endtag(self, tag):
+        self._flush_text()
+        if self._item is None:
+            return
+        for field, capture in list(self._captures.items()):
+            if capture[0] == tag:
+                capture[1] -= 1
+                if capture[1] == 0:
+                    self._item[field] = ''.join(capture[2])
+                    del self._captures[field]
+        if tag == 'li':
+            self._li_depth -= 1
+            if self._li_depth == 0:
+                self._finish_item()
+
+    def handle_data(self, data):
+        if self._captures:
+            self._pending.append(data)
+
+    def handle_comment(self, data):
+        self._flush_text()
+
+    def close(self):
+        super().close()
+        self._flush_text()
+        if self._item is not None:
+            self._finish_item()
+
+    def _finish_item(self):
+        for field, capture in self._captures.items():
+            self._item[field] = ''.join(capture[2])
+        self._captures = {}
+        item = self._item
+        self._item = None
+        self.products.append({
+            'titulo': item.get('titulo', 'No name'),
+            'link': item.get('link', self.base_url),
+            'imagen': item.get('imagen', 'No image'),
+            'precio': item.get('precio', 'No price'),
+        })
+        if self.limit is not None and len(self.products) >= self.limit:
+            raise _GridComplete()
+
+
+def parse_product_grid(source, limit=None):
+    # Extrae los productos de la grilla de una página de la tienda. `source`
+    # puede ser el HTML completo o un iterable de pedazos (p. ej. iter_content).
+    parser = ProductGridParser(limit)
+    try:
+        for chunk in ((source,) if isinstance(source, str) else source):
+            parser.feed(chunk)
+        parser.close()
+    except _GridComplete:
+        pass
+    return parser.products
+
+
+@stage_metrics.instrument('storefront.fetch')
+def fetch_products_from_surcansa(product_name):
+    # Consulta la tienda y devuelve los primeros productos; lanza excepción si falla
+    response = storefront.get(f"{SURCANSA_BASE_URL}/search", 'search', params={'q': product_name}, headers=SURCANSA_HEADERS, stream=True)
     try:
-        response = requests.get(search_url, headers=headers)
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        product_elements = soup.find_all('li', class_='grid__item')
-
-        products = []
-        base_url = "https://surcansa.com.ar"
-        for product in product_elements:
-            img_tag = product.find('img')
-            img_url = img_tag['src'] if img_tag else 'No image'
-            link_tag = product.find('a', class_='full-unstyled-link')
-            product_name = link_tag.get_text(strip=True) if link_tag else 'No name'
-            product_link = f"{base_url}{link_tag['href']}" if link_tag and link_tag['href'].startswith('/') else link_tag['href']
-            price_tag = product.find('span', class_='price-item--regular')
-            price = price_tag.get_text(strip=True) if price_tag else 'No price'
-
-            product = {
-                'titulo': product_name,
-                'link': product_link,
-                'imagen': img_url,
-                'precio': price
-            }
-            products.append(product)
-            print(f"Producto: {product_name}, Precio: {price}, Enlace: {product_link}, Imagen: {img_url}")
-        
-        if products:
-            productos = products[:5]
-            elements = []
-            for producto in productos:
-                elements.append({
-                    "title": producto['titulo'],
-                    "image_url": f"https:{producto['imagen']}",  # Asegurarse de que la URL de la imagen sea completa
-                    "subtitle": producto['precio'],
-                    "default_action": {
-                        "type": "web_url",
-                        "url": producto['link'],
-                        "webview_height_ratio": "tall",
-                    },
-                    "buttons": [
-                        {
-                            "type": "web_url",
-                            "url": producto['link'],
-                            "title": "Ver Producto"
-                        }
-                    ]
-                })
-            return {"carousel": elements}
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        products = parse_product_grid(
+            response.iter_content(chunk_size=SEARCH_PARSE_CHUNK, decode_unicode=True),
+            limit=SEARCH_RESULT_LIMIT,
+        )
+        # Se descarta el resto de la página sin parsearlo para que la conexión
+        # vuelva al pool en lugar de cerrarse
+        response.raw.drain_conn()
+    finally:
+        response.close()
+    logger.debug("Productos encontrados para '%s': %d", product_name, len(products))
+    return products[:SEARCH_RESULT_LIMIT]
+
+# Índice local del catálogo (SQLite FTS5). Un job en segundo plano recorre
+# /collections/all página por página y las búsquedas se responden desde acá.
+CATALOG_DB_PATH = os.getenv('CATALOG_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.db'))
+CATALOG_REFRESH_INTERVAL = float(os.getenv('CATALOG_REFRESH_INTERVAL', '3600'))  # 0 desactiva el job
+CATALOG_MAX_PAGES = int(os.getenv('CATALOG_MAX_PAGES', '200'))
+# Modo offline: si está definido, las páginas se leen de archivos .html de
+# este directorio (en orden alfabético) en lugar de pedirlas a la tienda.
+CATALOG_FIXTURES_DIR = os.getenv('CATALOG_FIXTURES_DIR')
+
+class CatalogIndex:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._ready = False
+        self._warned = False
+        self.stats = {'crawls': 0, 'pages_fetched': 0, 'pages_unchanged': 0,
+                      'pages_updated': 0, 'crawl_errors': 0, 'last_crawl_seconds': None,
+                      'unavailable': 0}
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS products USING fts5(
+                    titulo, link UNINDEXED, imagen UNINDEXED, precio UNINDEXED, page_url UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                );
+                CREATE TABLE IF NOT EXISTS catalog_pages (
+                    url TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    content_hash TEXT,
+                    product_count INTEGER NOT NULL DEFAULT 0,
+                    fetched_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS catalog_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+            ''')
+            self._local.conn = conn
+        return conn
 
-        else:
-            return {"response": f"No encontré productos para '{product_name}'."}
+    def _unavailable(self, error):
+        # Sin el archivo del índice (directorio inexistente, sin permisos...)
+        # las búsquedas siguen en vivo contra la tienda; se avisa una vez por proceso
+        self.stats['unavailable'] += 1
+        if not self._warned:
+            self._warned = True
+            logger.warning("Índice del catálogo no disponible en %s, se busca en la tienda: %s", self.path, error)
+
+    def ready(self):
+        # Listo cuando algún proceso terminó al menos un recorrido completo
+        if not self._ready:
+            try:
+                row = self._conn().execute("SELECT value FROM catalog_meta WHERE key = 'last_crawl'").fetchone()
+            except sqlite3.Error as e:
+                self._unavailable(e)
+                return False
+            self._ready = row is not None
+        return self._ready
+
+    @stage_metrics.instrument('catalog.search')
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        # Devuelve None si el índice no se puede leer (la búsqueda va a la tienda)
+        terms = [term.replace('"', '') for term in query.split()]
+        terms = [f'"{term}"*' for term in terms if term]
+        if not terms:
+            return []
+        try:
+            rows = self._conn().execute('''
+                SELECT titulo, link, imagen, precio FROM products
+                WHERE products MATCH ?
+                ORDER BY bm25(products) LIMIT ?
+            ''', (' '.join(terms), limit)).fetchall()
+        except sqlite3.Error as e:
+            self._unavailable(e)
+            return None
+        return [{'titulo': t, 'link': l, 'imagen': i, 'precio': p} for t, l, i, p in rows]
+
+    def _page_sources(self):
+        # Genera (url, fetch) para cada página del catálogo
+        if CATALOG_FIXTURES_DIR:
+            for name in sorted(os.listdir(CATALOG_FIXTURES_DIR)):
+                if name.endswith('.html'):
+                    path = os.path.join(CATALOG_FIXTURES_DIR, name)
+                    yield f"file://{path}", lambda cached, path=path: self._read_fixture(path)
+            return
+        for page in range(1, CATALOG_MAX_PAGES + 1):
+            url = f"{SURCANSA_BASE_URL}/collections/all?page={page}"
+            yield url, lambda cached, url=url: self._fetch_page(url, cached)
+
+    def _read_fixture(self, path):
+        with open(path, encoding='utf-8') as f:
+            return 200, f.read(), None, None
+
+    def _fetch_page(self, url, cached):
+        # GET condicional: con ETag/Last-Modified la tienda responde 304 si no cambió
+        headers = dict(SURCANSA_HEADERS)
+        if cached and cached[0]:
+            headers['If-None-Match'] = cached[0]
+        if cached and cached[1]:
+            headers['If-Modified-Since'] = cached[1]
+        response = storefront.get(url, 'collections', headers=headers)
+        if response.status_code == 304:
+            return 304, None, None, None
+        response.raise_for_status()
+        return 200, response.text, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+    def crawl(self):
+        # Recorrido incremental: solo se vuelven a indexar las páginas cuyo contenido cambió
+        started = time.monotonic()
+        conn = self._conn()
+        seen = []
+        for url, fetch in self._page_sources():
+            cached = conn.execute(
+                'SELECT etag, last_modified, content_hash, product_count FROM catalog_pages WHERE url = ?', (url,)
+            ).fetchone()
+            status, html, etag, last_modified = fetch(cached)
+            self.stats['pages_fetched'] += 1
+            seen.append(url)
+
+            if status == 304:
+                self.stats['pages_unchanged'] += 1
+                conn.execute('UPDATE catalog_pages SET fetched_at = ? WHERE url = ?', (time.time(), url))
+                conn.commit()
+                if not cached[3]:
+                    break
+                continue
+
+            content_hash = hashlib.sha1(html.encode('utf-8')).hexdigest()
+            if cached and cached[2] == content_hash:
+                self.stats['pages_unchanged'] += 1
+                product_count = cached[3]
+            else:
+                products = parse_product_grid(html)
+                product_count = len(products)
+                with conn:
+                    conn.execute('DELETE FROM products WHERE page_url = ?', (url,))
+                    conn.executemany(
+                        'INSERT INTO products (titulo, link, imagen, precio, page_url) VALUES (?, ?, ?, ?, ?)',
+                        [(p['titulo'], p['link'], p['imagen'], p['precio'], url) for p in products]
+                    )
+                self.stats['pages_updated'] += 1
+            with conn:
+                conn.execute('''
+                    INSERT INTO catalog_pages (url, etag, last_modified, content_hash, product_count, fetched_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified,
+                        content_hash = excluded.content_hash, product_count = excluded.product_count,
+                        fetched_at = excluded.fetched_at
+                ''', (url, etag, last_modified, content_hash, product_count, time.time()))
+            # Una página sin productos marca el final del catálogo
+            if not product_count and not CATALOG_FIXTURES_DIR:
+                break
+
+        # Eliminar páginas que ya no existen
+        with conn:
+            placeholders = ','.join('?' * len(seen))
+            conn.execute(f'DELETE FROM products WHERE page_url NOT IN ({placeholders})', seen)
+            conn.execute(f'DELETE FROM catalog_pages WHERE url NOT IN ({placeholders})', seen)
+            conn.execute(
+                "INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('last_crawl', ?)",
+                (datetime.now(timezone.utc).isoformat(),)
+            )
+        self.stats['crawls'] += 1
+        self.stats['last_crawl_seconds'] = round(time.monotonic() - started, 3)
+        self._ready = True
+
+    def crawl_exclusive(self):
+        # Solo un worker por máquina recorre el catálogo; el resto lee el mismo archivo
+        with open(self.path + '.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                self.crawl()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return True
+
+    def snapshot(self):
+        stats = dict(self.stats)
+        stats['ready'] = self.ready()
+        try:
+            stats['products'] = self._conn().execute('SELECT count(*) FROM products').fetchone()[0]
+        except sqlite3.Error as e:
+            stats['products'] = None
+            stats['error'] = str(e)
+        return stats
+
+catalog_index = CatalogIndex(CATALOG_DB_PATH)
+
+_catalog_refresher_pid = None
+_catalog_refresher_lock = threading.Lock()
+
+def _catalog_refresh_loop():
+    while True:
+        try:
+            catalog_index.crawl_exclusive()
+        except Exception as e:
+            catalog_index.stats['crawl_errors'] += 1
+            logger.error("Error actualizando el índice del catálogo: %s", e)
+        time.sleep(CATALOG_REFRESH_INTERVAL)
+
+def start_catalog_refresher():
+    # Un hilo por worker (los hilos no sobreviven al fork de gunicorn)
+    global _catalog_refresher_pid
+    if CATALOG_REFRESH_INTERVAL <= 0 or _catalog_refresher_pid == os.getpid():
+        return
+    with _catalog_refresher_lock:
+        if _catalog_refresher_pid != os.getpid():
+            threading.Thread(target=_catalog_refresh_loop, daemon=True).start()
+            _catalog_refresher_pid = os.getpid()
+
+@bp.cli.command('crawl-catalog')
+def crawl_catalog_command():
+    catalog_index.crawl()
+    print(f"Índice del catálogo actualizado: {catalog_index.snapshot()}")
+
+def find_products(query):
+    # Con el índice local listo la búsqueda es una consulta a SQLite; mientras
+    # tanto se consulta la tienda en vivo a través de la caché.
+    if catalog_index.ready():
+        products = catalog_index.search(query)
+        if products is not None:
+            return products
+    return search_cache.get_or_load(query, lambda: load_products(query))
+
+def load_products(query):
+    # Búsquedas iguales en curso comparten la consulta a la tienda
+    return search_flight.do(query, lambda: fetch_products_from_surcansa(query))
+
+@stage_metrics.instrument('search')
+def search_product_on_surcansa(product_name, render=None):
+    # render convierte los productos en la respuesta; por defecto, el carrusel de /chat
+    query = normalize_user_input(product_name)
+    try:
+        productos = find_products(query)
     except Exception as e:
         return {"response": f"Ocurrió un error inesperado: {str(e)}"}
+    return (render or format_search_results)(product_name, productos)
+
+def no_products_found(product_name):
+    return {"response": f"No encontré productos para '{product_name}'."}
+
+def format_search_results(product_name, productos):
+    if productos:
+        elements = []
+        for producto in productos:
+            elements.append({
+                "title": producto['titulo'],
+                "image_url": f"https:{producto['imagen']}",  # Asegurarse de que la URL de la imagen sea completa
+                "subtitle": producto['precio'],
+                "default_action": {
+                    "type": "web_url",
+                    "url": producto['link'],
+                    "webview_height_ratio": "tall",
+                },
+                "buttons": [
+                    {
+                        "type": "web_url",
+                        "url": producto['link'],
+                        "title": "Ver Producto"
+                    }
+                ]
+            })
+        return {"carousel": elements}
+
+    else:
+        return no_products_found(product_name)
 
 # Prueba de la función
 #productos = search_product_on_anyway('celular')
 #for producto in productos:
-    print(producto)
-    
+#    print(producto)
 
 
-@app.route('/search_product', methods=['POST'])
+@bp.route('/search_product', methods=['POST'])
 def search_product():
     data = request.json
     product_name = data.get('product_name')
@@ -543,19 +3171,258 @@ def search_product():
     productos = search_product_on_surcansa(product_name)
     return jsonify(productos)
 
-@app.route('/favicon.ico')
+@bp.route('/favicon.ico')
 def favicon():
     return send_from_directory(
-        os.path.join(app.root_path, 'static'),
+        os.path.join(current_app.root_path, 'static'),
         'favicon.ico',
         mimetype='image/vnd.microsoft.icon'
     )
 
-@app.route('/reset', methods=['POST'])
+def process_memory():
+    # Memoria del proceso en KiB según /proc (solo Linux). USS es la memoria
+    # privada del worker; la compartida con el maestro (p. ej. el modelo) no suma.
+    memory = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    memory[line.split(':')[0].lower()] = int(line.split()[1])
+        with open('/proc/self/smaps_rollup') as f:
+            next(f)  # primera línea: rango de direcciones
+            fields = dict(line.split(':', 1) for line in f)
+        memory['pss'] = int(fields['Pss'].split()[0])
+        memory['uss'] = int(fields['Private_Clean'].split()[0]) + int(fields['Private_Dirty'].split()[0])
+        memory['shared'] = int(fields['Shared_Clean'].split()[0]) + int(fields['Shared_Dirty'].split()[0])
+    except (OSError, KeyError, ValueError):
+        pass
+    return memory
+
+def nlp_model_stats():
+    return {
+        'loaded': _nlp is not None,
+        'load_seconds': round(NLP_LOAD_SECONDS, 3) if NLP_LOAD_SECONDS is not None else None,
+        'loaded_in_pid': NLP_LOADED_IN_PID,
+        'shared_from_parent': NLP_LOADED_IN_PID not in (None, os.getpid()),
+        'pid': os.getpid(),
+        'memory_kib': process_memory(),
+    }
+
+def stats_snapshot():
+    return {
+        'db_pool': db_pool_stats(),
+        'nlp_model': nlp_model_stats(),
+        'nlp_cache': nlp_cache_stats(),
+        'search_cache': search_cache.snapshot(),
+        'catalog_index': catalog_index.snapshot(),
+        'webhook': webhook_dispatcher.snapshot(),
+        'conversations': conversation_store.snapshot(),
+        'context_window': context_window.snapshot(),
+        'openai': openai_stats.snapshot(),
+        'faq_cache': faq_cache.snapshot(),
+        'single_flight': single_flight_stats(),
+        'whatsapp_payloads': whatsapp_payloads.snapshot(),
+        'counts': counts_aggregator.snapshot(),
+        'logging': log_handler.snapshot(),
+        'active_conversations': active_conversations.snapshot(),
+        'conversation_sweeper': conversation_sweeper.snapshot(),
+        'http': {'graph_api': graph_api.snapshot(), 'storefront': storefront.snapshot()},
+        'stages': stage_metrics.snapshot(),
+    }
+
+@bp.route('/stats')
+def stats():
+    return jsonify(stats_snapshot())
+
+def _prom_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+def _prom_histogram(lines, name, snapshot, **labels):
+    for bound, count in snapshot['buckets'].items():
+        lines.append(f"{name}_bucket{_prom_labels(**labels, le=bound)} {count}")
+    lines.append(f"{name}_sum{_prom_labels(**labels)} {snapshot['sum']}")
+    lines.append(f"{name}_count{_prom_labels(**labels)} {snapshot['count']}")
+
+# /stats mezcla contadores, valores actuales y configuración. En /metrics los
+# IDs y la configuración se omiten, los valores actuales van como gauges y el
+# resto son contadores (solo crecen) con el sufijo _total.
+PROM_SKIP_KEYS = {'pid', 'loaded_in_pid', 'max_size', 'budget', 'threshold', 'workers', 'interval',
+                  'debug_sample_rate', 'cross_worker', 'persistent'}
+PROM_GAUGE_KEYS = {'in_use', 'max_in_use', 'idle', 'initialized', 'loaded', 'shared_from_parent', 'load_seconds',
+                   'memory_kib', 'size', 'entries', 'ready', 'products', 'queued', 'in_progress', 'in_flight',
+                   'cached_users', 'cached_summaries', 'hit_rate', 'coalescing_ratio', 'latency_seconds_max',
+                   'wait_seconds_max', 'last_prompt_tokens', 'last_completion_tokens', 'pending_daily',
+                   'pending_monthly'}
+
+def _prom_flatten(lines, prefix, value, gauge=False):
+    # El camino de claves es el nombre: chatbot_search_cache_hits_total,
+    # chatbot_db_pool_in_use...
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in ('latency', 'stages') or key in PROM_SKIP_KEYS:
+                continue  # latency y stages se publican como histogramas
+            _prom_flatten(lines, f"{prefix}_{key}", item, gauge or key in PROM_GAUGE_KEYS)
+    elif isinstance(value, (int, float)):
+        name = ''.join(c if c.isalnum() else '_' for c in prefix)
+        if gauge:
+            lines.append(f"# TYPE {name} gauge")
+        else:
+            if not name.endswith('_total'):
+                name += '_total'
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {float(value)}")
+
+def render_metrics():
+    lines = []
+    stages, routes = stage_metrics.collect()
+
+    lines.append('# HELP chatbot_stage_duration_seconds Latencia por etapa del pipeline')
+    lines.append('# TYPE chatbot_stage_duration_seconds histogram')
+    for stage, histogram, _ in stages:
+        _prom_histogram(lines, 'chatbot_stage_duration_seconds', histogram.snapshot(), stage=stage)
+    lines.append('# HELP chatbot_stage_calls_total Llamadas por etapa')
+    lines.append('# TYPE chatbot_stage_calls_total counter')
+    for stage, _, counters in stages:
+        lines.append(f"chatbot_stage_calls_total{_prom_labels(stage=stage)} {counters['calls']}")
+    lines.append('# HELP chatbot_stage_errors_total Llamadas que terminaron con excepción')
+    lines.append('# TYPE chatbot_stage_errors_total counter')
+    for stage, _, counters in stages:
+        lines.append(f"chatbot_stage_errors_total{_prom_labels(stage=stage)} {counters['errors']}")
+
+    lines.append('# HELP chatbot_http_request_duration_seconds Latencia por ruta (hasta el primer byte en SSE)')
+    lines.append('# TYPE chatbot_http_request_duration_seconds histogram')
+    for (route, method), histogram, _ in routes:
+        _prom_histogram(lines, 'chatbot_http_request_duration_seconds', histogram.snapshot(), route=route, method=method)
+    lines.append('# HELP chatbot_http_requests_total Solicitudes por ruta y estado')
+    lines.append('# TYPE chatbot_http_requests_total counter')
+    for (route, method), _, statuses in routes:
+        for status, count in sorted(statuses.items()):
+            lines.append(f"chatbot_http_requests_total{_prom_labels(route=route, method=method, status=status)} {count}")
+
+    lines.append('# HELP chatbot_upstream_request_duration_seconds Latencia de las llamadas a servicios externos')
+    lines.append('# TYPE chatbot_upstream_request_duration_seconds histogram')
+    for client in (graph_api, storefront):
+        for endpoint, histogram in list(client.latency.items()):
+            _prom_histogram(lines, 'chatbot_upstream_request_duration_seconds', histogram.snapshot(), service=client.name, endpoint=endpoint)
+
+    _prom_flatten(lines, 'chatbot', stats_snapshot())
+    return '\n'.join(lines) + '\n'
+
+@bp.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/counts')
+def counts():
+    day = request.args.get('date')
+    try:
+        day = datetime.strptime(day, '%Y-%m-%d').date() if day else None
+    except ValueError:
+        return jsonify({"error": "Fecha inválida, usar AAAA-MM-DD"}), 400
+    return jsonify(get_counts(day))
+
+@bp.route('/reset', methods=['POST'])
 def reset():
-    session.pop('messages', None)
+    user_id = web_conversation_key(session['user_id'])
+    conversation_store.reset(user_id)
+    context_window.reset(user_id)
     return jsonify({'status': 'session reset'})
 
 
+# Arranque: los componentes pesados (modelo, pool de la base, cliente de
+# OpenAI) se inicializan en un hilo de calentamiento para que el worker pueda
+# responder /healthz enseguida; /readyz indica cuándo están listos.
+#   APP_WARMUP=background  calentamiento en segundo plano (por defecto)
+#   APP_WARMUP=sync        calentamiento bloqueante dentro de create_app
+#   APP_WARMUP=preload     modelo y OpenAI en create_app, la base por worker
+#                          (lo usa gunicorn.conf.py con preload_app)
+#   APP_WARMUP=lazy        cada componente se inicializa en su primer uso
+APP_WARMUP = os.getenv('APP_WARMUP', 'background')
+WARM_UP_COMPONENTS = ('nlp', 'openai', 'db')
+warm_up_errors = {}
+_warm_up_thread = None
+_warm_up_pid = None
+
+def warm_up(components=WARM_UP_COMPONENTS):
+    started = time.perf_counter()
+    for component in components:
+        try:
+            if component == 'nlp':
+                get_nlp()
+            elif component == 'openai':
+                get_openai()
+            elif component == 'db' and DATABASE_URL:
+                db_started = time.perf_counter()
+                get_db_pool()
+                STARTUP_PROFILE['db_pool'] = round(time.perf_counter() - db_started, 3)
+            warm_up_errors.pop(component, None)
+        except Exception as e:
+            warm_up_errors[component] = str(e)
+            logger.error("Error inicializando %s: %s", component, e)
+    STARTUP_PROFILE['warm_up'] = round(time.perf_counter() - started, 3)
+
+def start_warm_up(components=WARM_UP_COMPONENTS):
+    # Un hilo por proceso; con preload se vuelve a llamar en cada worker
+    global _warm_up_thread, _warm_up_pid
+    if _warm_up_pid == os.getpid():
+        return _warm_up_thread
+    _warm_up_thread = threading.Thread(target=warm_up, args=(components,), daemon=True)
+    _warm_up_thread.start()
+    _warm_up_pid = os.getpid()
+    return _warm_up_thread
+
+def readiness():
+    db_ready = _db_pool is not None and _db_pool_pid == os.getpid()
+    checks = {
+        'nlp': _nlp is not None,
+        'openai': _openai is not None,
+        'db': db_ready if DATABASE_URL else 'not_configured',
+    }
+    ready = all(value is True or value == 'not_configured' for value in checks.values())
+    return ready, checks
+
+@bp.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+@bp.route('/readyz')
+def readyz():
+    ready, checks = readiness()
+    return jsonify({
+        'ready': ready,
+        'checks': checks,
+        'errors': warm_up_errors,
+        'startup_profile': STARTUP_PROFILE,
+    }), 200 if ready else 503
+
+def create_app(warmup=None):
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.secret_key = os.urandom(24)
+    CORS(app, resources={r"/*": {"origins": "*"}})
+    app.config['DEBUG'] = True
+    app.register_blueprint(bp)
+
+    mode = warmup or APP_WARMUP
+    if mode == 'sync':
+        warm_up()
+    elif mode == 'preload':
+        warm_up(('nlp', 'openai'))
+    elif mode == 'background':
+        start_warm_up()
+    STARTUP_PROFILE['create_app'] = round(time.perf_counter() - started, 3)
+    return app
+
+STARTUP_PROFILE['module_import'] = round(time.perf_counter() - _module_started, 3)
+app = create_app()
+
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    if '--startup-profile' in sys.argv:
+        # Para CI: esperar el calentamiento y mostrar los tiempos de arranque en JSON
+        if _warm_up_thread is not None:
+            _warm_up_thread.join()
+        print(json.dumps({'startup_profile': STARTUP_PROFILE, 'errors': warm_up_errors}, indent=2))
+    else:
+        app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,501 @@
+# Modo de servicio asíncrono (ASGI) para /chat, /webhook y /search_product.
+# Casi todo el tiempo de esas rutas es espera de I/O (OpenAI, la tienda, la
+# Graph API, Postgres), así que un solo proceso con un event loop puede atender
+# cientos de chats a la vez con una única copia del modelo de spaCy en memoria.
+# El resto de las rutas sigue siendo la app de Flask, montada con WsgiToAsgi.
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000
+#   gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+#
+# spaCy y el parseo de HTML (CPU) corren en un pool de hilos propio; psycopg2 y
+# SQLite no tienen cliente asíncrono en este proyecto y van a otro pool de hilos.
+import asyncio
+import contextvars
+import inspect
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from http.cookies import SimpleCookie
+
+import aiohttp
+from asgiref.wsgi import WsgiToAsgi
+from flask import json
+
+import app as chatbot
+
+NLP_THREADS = int(os.getenv('NLP_THREADS', '2'))
+IO_THREADS = int(os.getenv('IO_THREADS', '16'))
+USER_ID_MAX_AGE = 60*60*24*365*2
+
+logger = logging.getLogger('chatbot.asgi')
+
+flask_application = WsgiToAsgi(chatbot.app)
+
+
+class AsyncRuntime:
+    # Recursos ligados al event loop; se crean en el arranque (lifespan) o en el primer uso
+    def __init__(self):
+        self.session = None
+        self.nlp_executor = None
+        self.io_executor = None
+
+    def start(self):
+        if self.session is not None:
+            return
+        connector = aiohttp.TCPConnector(limit_per_host=chatbot.HTTP_POOL_SIZE)
+        timeout = aiohttp.ClientTimeout(sock_connect=chatbot.HTTP_CONNECT_TIMEOUT, sock_read=chatbot.HTTP_READ_TIMEOUT)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.nlp_executor = ThreadPoolExecutor(NLP_THREADS, thread_name_prefix='nlp')
+        self.io_executor = ThreadPoolExecutor(IO_THREADS, thread_name_prefix='io')
+        chatbot.start_catalog_refresher()
+        chatbot.conversation_sweeper.start()
+        chatbot.webhook_dispatcher.start()
+
+    async def stop(self):
+        if self.session is None:
+            return
+        await self.session.close()
+        self.nlp_executor.shutdown(wait=False)
+        self.io_executor.shutdown(wait=True)
+        self.session = None
+        chatbot.counts_aggregator.flush()
+
+    async def nlp(self, func, *args):
+        self.start()
+        # run_in_executor no propaga los contextvars (request_id para los logs)
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.nlp_executor, ctx.run, func, *args)
+
+    async def io(self, func, *args):
+        self.start()
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, ctx.run, func, *args)
+
+
+runtime = AsyncRuntime()
+
+
+def instrument_async(stage):
+    # Equivalente de stage_metrics.instrument para corrutinas y generadores
+    # asíncronos (varias tareas comparten el hilo, así que se mide cada llamada)
+    def record(started, error):
+        chatbot.stage_metrics.observe(stage, time.perf_counter() - started, error)
+
+    def decorator(func):
+        if inspect.isasyncgenfunction(func):
+            @wraps(func)
+            async def generator_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    async for item in func(*args, **kwargs):
+                        yield item
+                except Exception:
+                    record(started, True)
+                    raise
+                record(started, False)
+            return generator_wrapper
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception:
+                record(started, True)
+                raise
+            record(started, False)
+            return result
+        return wrapper
+    return decorator
+
+
+class AsyncSingleFlight:
+    # Contraparte de chatbot.SingleFlight para las corrutinas del event loop;
+    # suma en las mismas estadísticas. La llamada corre en su propia tarea, así
+    # que si el cliente que la inició se desconecta los demás igual reciben el
+    # resultado. Con SINGLE_FLIGHT_DB_PATH también se coordina con los demás
+    # workers por el mismo SharedFlightStore.
+    def __init__(self, flight):
+        self.flight = flight
+        self._tasks = {}
+
+    async def do(self, key, coroutine_function):
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(self._run(key, coroutine_function))
+        else:
+            self.flight.record('calls', 'coalesced')
+        return await asyncio.shield(task)
+
+    async def _run(self, key, coroutine_function):
+        try:
+            if self.flight.shared is None:
+                result, outcome = await coroutine_function(), 'executions'
+            else:
+                result, outcome = await self._run_shared(f"{self.flight.name}:{key}", coroutine_function)
+        except Exception:
+            self.flight.record('calls', 'errors')
+            raise
+        finally:
+            del self._tasks[key]
+        self.flight.record('calls', outcome)
+        return result
+
+    async def _run_shared(self, key, coroutine_function):
+        # Los mismos pasos que SharedFlightStore.run, pero esperando al otro
+        # worker con asyncio.sleep: el lock no bloquea y SQLite va al pool de I/O
+        store = self.flight.shared
+        value = await runtime.io(store.result, key)
+        if value is not chatbot.CACHE_MISS:
+            return value, 'shared'
+        deadline = time.monotonic() + store.wait
+        while True:
+            acquired = store.acquire(key)
+            if acquired is None:
+                return await coroutine_function(), 'executions'
+            if acquired:
+                break
+            if time.monotonic() >= deadline:
+                logger.warning("Venció la espera del resultado compartido de '%s'", key)
+                return await coroutine_function(), 'shared_timeouts'
+            await asyncio.sleep(chatbot.SINGLE_FLIGHT_POLL_INTERVAL)
+            value = await runtime.io(store.result, key)
+            if value is not chatbot.CACHE_MISS:
+                return value, 'shared'
+        try:
+            value = await runtime.io(store.result, key)
+            if value is not chatbot.CACHE_MISS:
+                return value, 'shared'
+            value = await coroutine_function()
+            await runtime.io(store.store, key, value)
+            return value, 'executions'
+        finally:
+            store.release(key)
+
+
+search_flight = AsyncSingleFlight(chatbot.search_flight)
+faq_flight = AsyncSingleFlight(chatbot.faq_flight)
+
+
+async def upstream_request(client, method, url, endpoint, idempotent=None, **kwargs):
+    # Contraparte asíncrona de UpstreamClient.request: usa el mismo circuit
+    # breaker, histogramas y política de reintentos. Devuelve (estado, cuerpo).
+    runtime.start()
+    if idempotent is None:
+        idempotent = method.upper() in ('GET', 'HEAD')
+    histogram = client.latency.get(endpoint)
+    if histogram is None:
+        histogram = client.latency.setdefault(endpoint, chatbot.Histogram())
+
+    for attempt in range(chatbot.HTTP_MAX_RETRIES + 1):
+        if not client.breaker.allow():
+            client.stats['short_circuited'] += 1
+            raise chatbot.CircuitOpenError(f"Circuito abierto para {client.name}")
+        client.stats['requests'] += 1
+        started = time.monotonic()
+        retry_after = None
+        try:
+            async with runtime.session.request(method, url, **kwargs) as response:
+                status = response.status
+                body = await response.read()
+                retry_after = response.headers.get('Retry-After')
+        except aiohttp.ClientConnectorError as e:
+            # No se llegó a conectar: el pedido no se envió
+            histogram.observe(time.monotonic() - started)
+            client.breaker.record_failure()
+            error, retryable = e, True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            histogram.observe(time.monotonic() - started)
+            client.breaker.record_failure()
+            error, retryable = e, idempotent
+        except Exception:
+            histogram.observe(time.monotonic() - started)
+            client.breaker.record_failure()
+            client.stats['failures'] += 1
+            raise
+        except BaseException:
+            # Cancelada (el cliente se desconectó): no es una falla del servicio,
+            # pero si era la prueba del semiabierto hay que liberarla
+            client.breaker.release()
+            raise
+        else:
+            histogram.observe(time.monotonic() - started)
+            if status >= 500:
+                client.breaker.record_failure()
+            else:
+                client.breaker.record_success()
+            if status not in chatbot.RETRY_STATUSES:
+                return status, body
+            error, retryable = None, idempotent or status == 429
+
+        if not retryable or attempt == chatbot.HTTP_MAX_RETRIES:
+            client.stats['failures'] += 1
+            if error is not None:
+                raise error
+            return status, body
+        client.stats['retries'] += 1
+        await asyncio.sleep(client.backoff(attempt, retry_after))
+
+
+@instrument_async('storefront.fetch')
+async def fetch_products_async(query):
+    status, body = await upstream_request(
+        chatbot.storefront, 'GET', f"{chatbot.SURCANSA_BASE_URL}/search", 'search',
+        params={'q': query}, headers=chatbot.SURCANSA_HEADERS,
+    )
+    if status >= 400:
+        raise RuntimeError(f"La tienda respondió {status}")
+    products = await runtime.nlp(
+        chatbot.parse_product_grid, body.decode('utf-8', errors='replace'), chatbot.SEARCH_RESULT_LIMIT,
+    )
+    return products
+
+
+async def find_products_async(query):
+    # Misma lógica que find_products: índice local si está listo, si no caché + tienda
+    if await runtime.io(chatbot.catalog_index.ready):
+        products = await runtime.io(chatbot.catalog_index.search, query)
+        if products is not None:
+            return products
+    cached = chatbot.search_cache.lookup(query, lambda: chatbot.load_products(query))
+    if cached is not chatbot.CACHE_MISS:
+        return cached
+    products = await search_flight.do(query, lambda: fetch_products_async(query))
+    chatbot.search_cache.set(query, products)
+    return products
+
+
+@instrument_async('search')
+async def search_product_async(product_name):
+    query = chatbot.normalize_user_input(product_name)
+    try:
+        productos = await find_products_async(query)
+    except Exception as e:
+        return {"response": f"Ocurrió un error inesperado: {str(e)}"}
+    return chatbot.format_search_results(product_name, productos)
+
+
+@instrument_async('openai.chat')
+async def chat_completion_async(messages, **kwargs):
+    started = time.monotonic()
+    try:
+        response = await chatbot.get_openai().ChatCompletion.acreate(model=chatbot.OPENAI_MODEL, messages=messages, **kwargs)
+    except Exception:
+        chatbot.openai_stats.record_error()
+        raise
+    usage = response.get('usage') or {}
+    chatbot.openai_stats.record_call(usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), time.monotonic() - started)
+    return response
+
+
+@instrument_async('openai.chat_stream')
+async def chat_completion_stream_async(messages, **kwargs):
+    started = time.monotonic()
+    parts = []
+    try:
+        async for chunk in await chatbot.get_openai().ChatCompletion.acreate(
+            model=chatbot.OPENAI_MODEL, messages=messages, stream=True, **kwargs
+        ):
+            delta = chunk.choices[0].delta.get('content')
+            if delta:
+                if not parts:
+                    chatbot.openai_stats.record_first_token(time.monotonic() - started)
+                parts.append(delta)
+                yield delta
+    except Exception:
+        chatbot.openai_stats.record_error()
+        raise
+    chatbot.openai_stats.record_call(
+        chatbot.estimate_prompt_tokens(messages), chatbot.count_tokens(''.join(parts)), time.monotonic() - started,
+    )
+
+
+@instrument_async('chat_events')
+async def chat_events(user_id, user_input, stream):
+    # Versión asíncrona de stream_user_input, con los mismos pasos de app.py
+    history = await runtime.io(chatbot.begin_turn, user_id, user_input)
+    try:
+        is_search, product_name = await runtime.nlp(chatbot.analyze_user_input, user_input)
+        if is_search:
+            bot_message = chatbot.search_reply(await search_product_async(product_name))
+            yield ('carousel' if 'carousel' in bot_message else 'response'), bot_message
+            return
+
+        # El análisis ya está en caché, así que la búsqueda semántica no vuelve a pasar por spaCy
+        reply = chatbot.cached_reply(user_input, history)
+        cacheable = False
+        if reply is None:
+            # build puede llamar a OpenAI para resumir turnos viejos
+            messages = await runtime.io(chatbot.context_window.build, user_id, history, user_input)
+            if stream:
+                parts = []
+                async for delta in chat_completion_stream_async(messages, temperature=0.01):
+                    parts.append(delta)
+                    yield 'token', {"delta": delta}
+                reply = "".join(parts).strip()
+            else:
+                async def complete():
+                    response = await chat_completion_async(messages, temperature=0.01)
+                    return response.choices[0].message['content'].strip()
+                if history:
+                    reply = await complete()
+                else:
+                    # Igual que en process_user_input: sin historial, las preguntas
+                    # iguales en curso comparten la llamada
+                    reply = await faq_flight.do(chatbot.normalize_user_input(user_input), complete)
+            cacheable = not history
+
+        reply = await runtime.io(chatbot.finish_turn, user_id, user_input, reply, cacheable)
+        yield 'done', {"response": reply}
+    except Exception:
+        logger.exception("Error procesando el mensaje")
+        yield 'error', {"response": "Lo siento, hubo un problema al procesar tu solicitud."}
+
+
+# Utilidades HTTP mínimas sobre ASGI
+
+def _headers(scope):
+    return {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+
+
+async def _read_json(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return None
+
+
+async def _send(send, status, body, content_type='application/json', headers=()):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type.encode('latin-1')),
+            (b'content-length', str(len(body)).encode('latin-1')),
+            (b'access-control-allow-origin', b'*'),
+        ] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _instrumented_send(send, scope, request_id, started):
+    # Agrega X-Request-ID (y Server-Timing) y registra la métrica de la ruta al
+    # empezar la respuesta, igual que los hooks de Flask
+    async def wrapped(message):
+        if message['type'] == 'http.response.start':
+            elapsed = time.perf_counter() - started
+            headers = list(message.get('headers', [])) + [(b'x-request-id', request_id.encode('latin-1'))]
+            timings = chatbot.request_timings_var.get()
+            if timings is not None:
+                headers.append((b'server-timing', chatbot.server_timing_header(timings, elapsed).encode('latin-1')))
+            message['headers'] = headers
+            chatbot.stage_metrics.observe_request(scope['path'], scope['method'], message['status'], elapsed)
+        await send(message)
+    return wrapped
+
+
+def _user_id(headers):
+    # Igual que ensure_user_id: una cookie que no es un UUID recibe uno nuevo
+    cookies = SimpleCookie(headers.get('cookie', ''))
+    user_id = chatbot.parse_user_id(cookies['user_id'].value) if 'user_id' in cookies else None
+    if user_id:
+        return user_id, []
+    user_id = str(uuid.uuid4())
+    cookie = f"user_id={user_id}; Max-Age={USER_ID_MAX_AGE}; Path=/"
+    return user_id, [(b'set-cookie', cookie.encode('latin-1'))]
+
+
+async def chat_endpoint(scope, receive, send):
+    headers = _headers(scope)
+    user_id, cookie_headers = _user_id(headers)
+    data = await _read_json(receive)
+    if not isinstance(data, dict) or not data.get('input'):
+        return await _send(send, 400, 'Error en la solicitud.', 'text/plain; charset=utf-8')
+    user_input = data['input']
+    conversation_key = chatbot.web_conversation_key(user_id)
+
+    if 'text/event-stream' in headers.get('accept', ''):
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                (b'access-control-allow-origin', b'*'),
+            ] + cookie_headers,
+        })
+        async for event, payload in chat_events(conversation_key, user_input, stream=True):
+            chunk = f"event: {event}\ndata: {json.dumps(payload)}\n\n".encode('utf-8')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    result = None
+    async for event, payload in chat_events(conversation_key, user_input, stream=False):
+        result = payload
+    await _send(send, 200, json.dumps(result), headers=cookie_headers)
+
+
+async def webhook_endpoint(scope, receive, send):
+    # Solo encola (una escritura en la cola SQLite); los hilos de webhook_dispatcher procesan
+    data = await _read_json(receive)
+    body, status = await runtime.io(chatbot.enqueue_webhook_payload, data)
+    await _send(send, status, body, 'text/plain; charset=utf-8')
+
+
+async def search_product_endpoint(scope, receive, send):
+    data = await _read_json(receive)
+    product_name = data.get('product_name') if isinstance(data, dict) else None
+    if not product_name:
+        return await _send(send, 400, json.dumps({"error": "No se proporcionó el nombre del producto"}))
+    await _send(send, 200, json.dumps(await search_product_async(product_name)))
+
+
+ASYNC_ROUTES = {
+    ('POST', '/chat'): chat_endpoint,
+    ('POST', '/webhook'): webhook_endpoint,
+    ('POST', '/search_product'): search_product_endpoint,
+}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                runtime.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await runtime.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        if handler is not None:
+            runtime.start()
+            # Cada solicitud corre en su propia tarea, así que el contextvar no se mezcla
+            started = time.perf_counter()
+            request_id = _headers(scope).get('x-request-id') or uuid.uuid4().hex
+            chatbot.request_id_var.set(request_id)
+            # aiosession es un contextvar: fijarlo en el arranque (lifespan) no
+            # llega a las tareas de las solicitudes, y sin él acreate abre una
+            # sesión (y un handshake TLS) por llamada
+            chatbot.get_openai().aiosession.set(runtime.session)
+            chatbot.request_timings_var.set([] if chatbot.SERVER_TIMING else None)
+            return await handler(scope, receive, _instrumented_send(send, scope, request_id, started))
+
+    # Todo lo demás (/, /stats, verificación GET del webhook, preflight CORS...) lo atiende Flask
+    return await flask_application(scope, receive, send)
@@ -0,0 +1,324 @@
+"""Prueba de carga de /chat, /webhook y /search_product.
+
+Cada escenario se corre con cada nivel de concurrencia durante un tiempo fijo
+(después de unas solicitudes de calentamiento) y se reporta p50/p95/p99, media
+y solicitudes por segundo. El resultado es un JSON con el commit, así dos
+corridas se pueden comparar:
+
+    python bench/load.py run --target http://127.0.0.1:5000 --mock http://127.0.0.1:8900 \\
+        --scenarios chat,search,webhook --concurrency 1,8,32 --duration 20
+    python bench/load.py compare bench/results/abc1234.json bench/results/def5678.json
+
+bench/run.py levanta los servicios simulados y la app y llama a este script.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+import uuid
+
+import aiohttp
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+QUESTIONS = [
+    "¿Cuál es el horario de atención?",
+    "¿Hacen envíos a Posadas?",
+    "¿Qué formas de pago aceptan?",
+    "¿Dónde queda el local?",
+    "¿Tienen asesoramiento para obras?",
+    "¿Venden al por mayor?",
+]
+PRODUCTS = [
+    "cemento", "cal hidratada", "hierro 8mm", "arena fina", "ladrillo hueco",
+    "membrana líquida", "caño pvc 110", "adhesivo cerámico", "malla sima", "yeso",
+]
+
+
+class Scenario:
+    path = None
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.counter = itertools.count()
+
+    def request(self):
+        # (método, ruta, json, headers)
+        raise NotImplementedError
+
+    async def read(self, response, result):
+        await response.read()
+
+
+class ChatScenario(Scenario):
+    # Cada usuario virtual tiene su cookie, así el historial crece como en producción
+    path = '/chat'
+
+    def __init__(self, worker_id):
+        super().__init__(worker_id)
+        self.user_id = str(uuid.UUID(int=worker_id + 1))
+
+    def request(self):
+        question = QUESTIONS[(self.worker_id + next(self.counter)) % len(QUESTIONS)]
+        return 'POST', self.path, {'input': question}, {'Cookie': f"user_id={self.user_id}"}
+
+
+class ChatStreamScenario(ChatScenario):
+    def request(self):
+        method, path, body, headers = super().request()
+        return method, path, body, dict(headers, Accept='text/event-stream')
+
+    async def read(self, response, result):
+        # Tiempo hasta el primer evento además del total
+        async for _ in response.content.iter_any():
+            if 'first_event' not in result:
+                result['first_event'] = time.perf_counter()
+
+
+class SearchScenario(Scenario):
+    path = '/search_product'
+
+    def request(self):
+        product = PRODUCTS[(self.worker_id + next(self.counter)) % len(PRODUCTS)]
+        return 'POST', self.path, {'product_name': product}, {}
+
+
+class WebhookScenario(Scenario):
+    # Mide el acuse del webhook; las respuestas entregadas a la Graph API
+    # simulada se cuentan aparte (ver 'mock' en el resultado)
+    path = '/webhook'
+
+    def request(self):
+        n = next(self.counter)
+        phone = f"549376{self.worker_id:04d}{n % 10:03d}"
+        text = f"necesito {PRODUCTS[n % len(PRODUCTS)]}" if n % 2 else QUESTIONS[n % len(QUESTIONS)]
+        payload = {
+            'object': 'whatsapp_business_account',
+            'entry': [{'changes': [{'value': {'messages': [{
+                'id': f"wamid.bench-{uuid.uuid4().hex}",
+                'from': phone,
+                'type': 'text',
+                'text': {'body': text},
+            }]}}]}],
+        }
+        return 'POST', self.path, payload, {}
+
+
+SCENARIOS = {
+    'chat': ChatScenario,
+    'chat_stream': ChatStreamScenario,
+    'search': SearchScenario,
+    'webhook': WebhookScenario,
+}
+
+
+def percentile(sorted_values, p):
+    # Percentil por rango más cercano
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies):
+    values = sorted(latencies)
+    if not values:
+        return {}
+    return {
+        'p50': round(percentile(values, 50) * 1000, 2),
+        'p95': round(percentile(values, 95) * 1000, 2),
+        'p99': round(percentile(values, 99) * 1000, 2),
+        'mean': round(sum(values) / len(values) * 1000, 2),
+        'max': round(values[-1] * 1000, 2),
+    }
+
+
+async def one_request(session, target, scenario):
+    method, path, body, headers = scenario.request()
+    result = {}
+    started = time.perf_counter()
+    try:
+        async with session.request(method, target + path, json=body, headers=headers) as response:
+            await scenario.read(response, result)
+            status = response.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status = type(e).__name__
+    result['latency'] = time.perf_counter() - started
+    if 'first_event' in result:
+        result['first_event'] -= started
+    result['status'] = status
+    return result
+
+
+async def worker(session, target, scenario, deadline, results):
+    while time.perf_counter() < deadline:
+        results.append(await one_request(session, target, scenario))
+
+
+async def mock_stats(session, mock, path='/_stats'):
+    if not mock:
+        return {}
+    async with session.get(f"{mock}{path}") as response:
+        return await response.json()
+
+
+async def run_scenario(target, mock, name, concurrency, duration, warmup, timeout):
+    scenario_class = SCENARIOS[name]
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        scenarios = [scenario_class(i) for i in range(concurrency)]
+        for i in range(warmup):
+            await one_request(session, target, scenarios[i % concurrency])
+
+        before = await mock_stats(session, mock)
+        results = []
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(worker(session, target, s, deadline, results) for s in scenarios))
+        elapsed = time.perf_counter() - started
+        after = await mock_stats(session, mock)
+
+    ok = [r for r in results if isinstance(r['status'], int) and r['status'] < 400]
+    statuses = {}
+    for r in results:
+        statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+    summary = {
+        'scenario': name,
+        'concurrency': concurrency,
+        'duration': round(elapsed, 3),
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'rps': round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': summarize([r['latency'] for r in ok]),
+        'statuses': statuses,
+    }
+    first_events = [r['first_event'] for r in ok if 'first_event' in r]
+    if first_events:
+        summary['first_event_ms'] = summarize(first_events)
+    if mock:
+        summary['mock'] = {key: after.get(key, 0) - before.get(key, 0) for key in after}
+    return summary
+
+
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, dirty
+
+
+async def mock_config(mock):
+    async with aiohttp.ClientSession() as session:
+        return await mock_stats(session, mock, '/_config')
+
+
+async def run(args):
+    commit, dirty = git_revision()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'label': args.label,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'target': args.target,
+        'config': {
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'server': os.getenv('BENCH_SERVER', 'external'),
+            # Sin DATABASE_URL la app no usa la base (historial solo en memoria)
+            'database': 'postgres' if os.getenv('DATABASE_URL') else 'not_configured',
+            'mock': await mock_config(args.mock) if args.mock else None,
+        },
+        'results': [],
+    }
+    for name in args.scenarios.split(','):
+        for concurrency in (int(c) for c in args.concurrency.split(',')):
+            summary = await run_scenario(args.target, args.mock, name, concurrency, args.duration, args.warmup, args.timeout)
+            report['results'].append(summary)
+            latency = summary['latency_ms']
+            print(f"{name:12s} c={concurrency:<4d} {summary['rps']:8.1f} req/s  "
+                  f"p50 {latency.get('p50', 0):8.1f}  p95 {latency.get('p95', 0):8.1f}  p99 {latency.get('p99', 0):8.1f} ms  "
+                  f"errores {summary['errors']}", file=sys.stderr)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        suffix = f"-{args.label}" if args.label else ''
+        output = os.path.join(RESULTS_DIR, f"{commit}{'-dirty' if dirty else ''}{suffix}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(output)
+    return report
+
+
+def compare(base_path, new_path):
+    with open(base_path, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"base {base['commit']}{' (dirty)' if base.get('dirty') else ''}  ->  "
+          f"nuevo {new['commit']}{' (dirty)' if new.get('dirty') else ''}")
+    # Las latencias dependen de los servicios simulados y de la base: si no
+    # coinciden, la diferencia no es (solo) del código
+    for key in ('server', 'database', 'mock', 'cpus', 'python'):
+        old, value = base['config'].get(key), new['config'].get(key)
+        if old != value:
+            print(f"atención: config.{key} difiere: {old} -> {value}")
+    base_results = {(r['scenario'], r['concurrency']): r for r in base['results']}
+
+    def change(old, value):
+        if not old or value is None:
+            return '     n/a'
+        delta = (value - old) / old * 100
+        return f"{delta:+7.1f}%"
+
+    print(f"{'escenario':12s} {'c':>4s}  {'req/s':>16s}  {'p50 ms':>16s}  {'p95 ms':>16s}  {'p99 ms':>16s}")
+    for r in new['results']:
+        old = base_results.get((r['scenario'], r['concurrency']))
+        if old is None:
+            continue
+        cells = [f"{r['rps']:8.1f} {change(old['rps'], r['rps'])}"]
+        for p in ('p50', 'p95', 'p99'):
+            value = r['latency_ms'].get(p)
+            cells.append(f"{value if value is not None else 0:8.1f} {change(old['latency_ms'].get(p), value)}")
+        print(f"{r['scenario']:12s} {r['concurrency']:4d}  " + '  '.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--target', default='http://127.0.0.1:5000')
+    run_parser.add_argument('--mock', help='URL de bench/mock_services.py para contar lo que recibió')
+    run_parser.add_argument('--scenarios', default='chat,search,webhook', help=f"de: {','.join(SCENARIOS)}")
+    run_parser.add_argument('--concurrency', default='1,8,32')
+    run_parser.add_argument('--duration', type=float, default=20, help='segundos por escenario y concurrencia')
+    run_parser.add_argument('--warmup', type=int, default=10)
+    run_parser.add_argument('--timeout', type=float, default=60)
+    run_parser.add_argument('--label', default='')
+    run_parser.add_argument('--output', help=f"por defecto {RESULTS_DIR}/<commit>.json")
+
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        compare(args.base, args.new)
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Servicios simulados para los benchmarks: OpenAI, Graph API de WhatsApp y la tienda.
+
+Un solo servidor aiohttp atiende las tres APIs con latencia configurable, así
+las pruebas de carga no tocan servicios pagos ni de producción:
+
+    python bench/mock_services.py --port 8900 --openai-latency 0.8 --graph-latency 0.15
+
+    POST /v1/chat/completions           respuesta fija (JSON, o SSE con stream=true)
+    POST /{phone_number_id}/messages    acepta el envío como la Graph API
+    GET  /search?q=...                  página de búsqueda guardada en bench/fixtures
+    GET  /collections/all?page=N        la misma página en la 1 y vacía después
+    GET  /_stats                        solicitudes atendidas por ruta
+    GET  /_config                       latencias y demás parámetros con que corre
+
+La app se apunta acá con OPENAI_API_BASE=http://127.0.0.1:8900/v1,
+WHATSAPP_API_URL=http://127.0.0.1:8900 y SURCANSA_BASE_URL=http://127.0.0.1:8900.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+REPLY = (
+    "Surcan es una empresa familiar de Apóstoles, Misiones, con más de 40 años en "
+    "materiales de construcción. Podés visitarnos de lunes a sábado o escribirnos "
+    "por WhatsApp para consultar stock y precios."
+)
+
+
+class MockServices:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        with open(args.search_page, encoding='utf-8') as f:
+            self.search_page = f.read()
+        self.stats = {}
+
+    async def delay(self, route, base):
+        self.stats[route] = self.stats.get(route, 0) + 1
+        if base > 0:
+            await asyncio.sleep(max(0.0, self.random.gauss(base, base * self.args.jitter)))
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        prompt_tokens = sum(len(m.get('content', '').split()) for m in body.get('messages', []))
+        if not body.get('stream'):
+            await self.delay('openai', self.args.openai_latency)
+            return web.json_response({
+                'id': f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': body.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': REPLY}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(REPLY.split()),
+                          'total_tokens': prompt_tokens + len(REPLY.split())},
+            })
+
+        # En stream la latencia se reparte: primer token y luego el resto palabra a palabra
+        await self.delay('openai_stream', self.args.openai_latency * self.args.first_token_share)
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        words = REPLY.split(' ')
+        step = self.args.openai_latency * (1 - self.args.first_token_share) / len(words)
+        for i, word in enumerate(words):
+            chunk = {'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word}, 'finish_reason': None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            await asyncio.sleep(step)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def messages(self, request):
+        body = await request.json()
+        await self.delay('graph', self.args.graph_latency)
+        return web.json_response({
+            'messaging_product': 'whatsapp',
+            'contacts': [{'input': body.get('to'), 'wa_id': body.get('to')}],
+            'messages': [{'id': f"wamid.{uuid.uuid4().hex}"}],
+        })
+
+    async def search(self, request):
+        await self.delay('storefront', self.args.storefront_latency)
+        return web.Response(text=self.search_page, content_type='text/html')
+
+    async def collection(self, request):
+        await self.delay('storefront_collection', self.args.storefront_latency)
+        page = self.search_page if request.query.get('page', '1') == '1' else '<html><body></body></html>'
+        return web.Response(text=page, content_type='text/html')
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def get_config(self, request):
+        # load.py lo guarda en el reporte para que compare detecte corridas
+        # contra servicios simulados distintos
+        return web.json_response({
+            'openai_latency': self.args.openai_latency,
+            'first_token_share': self.args.first_token_share,
+            'graph_latency': self.args.graph_latency,
+            'storefront_latency': self.args.storefront_latency,
+            'jitter': self.args.jitter,
+            'seed': self.args.seed,
+            'search_page': os.path.basename(self.args.search_page),
+        })
+
+    def application(self):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        app.router.add_post('/{phone_number_id}/messages', self.messages)
+        app.router.add_get('/search', self.search)
+        app.router.add_get('/collections/all', self.collection)
+        app.router.add_get('/_stats', self.get_stats)
+        app.router.add_get('/_config', self.get_config)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--openai-latency', type=float, default=0.8, help='segundos por respuesta completa')
+    parser.add_argument('--first-token-share', type=float, default=0.3, help='fracción de la latencia hasta el primer token en stream')
+    parser.add_argument('--graph-latency', type=float, default=0.15)
+    parser.add_argument('--storefront-latency', type=float, default=0.3)
+    parser.add_argument('--jitter', type=float, default=0.1, help='desvío estándar relativo de la latencia')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--search-page', default=sorted(glob.glob(os.path.join(FIXTURES, 'search-*.html')))[0])
+    args = parser.parse_args()
+    web.run_app(MockServices(args).application(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Micro-benchmark del parser de la grilla de productos.
+
+Compara parse_product_grid (HTMLParser incremental, con y sin límite) contra el
+parser anterior basado en BeautifulSoup sobre las páginas guardadas en
+bench/fixtures, y verifica que los productos extraídos sean idénticos.
+
+    python bench/parse_grid.py [--repeat 50] [--chunk 16384] [fixture.html ...]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+os.environ.setdefault('APP_WARMUP', 'lazy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def parse_product_grid_soup(html):
+    # Implementación anterior, se conserva como referencia
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html, 'html.parser')
+    product_elements = soup.find_all('li', class_='grid__item')
+
+    products = []
+    base_url = app.SURCANSA_BASE_URL
+    for product in product_elements:
+        img_tag = product.find('img')
+        img_url = img_tag['src'] if img_tag else 'No image'
+        link_tag = product.find('a', class_='full-unstyled-link')
+        product_name = link_tag.get_text(strip=True) if link_tag else 'No name'
+        product_link = f"{base_url}{link_tag['href']}" if link_tag and link_tag['href'].startswith('/') else link_tag['href']
+        price_tag = product.find('span', class_='price-item--regular')
+        price = price_tag.get_text(strip=True) if price_tag else 'No price'
+
+        products.append({
+            'titulo': product_name,
+            'link': product_link,
+            'imagen': img_url,
+            'precio': price
+        })
+    return products
+
+
+def chunked(text, size):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def timeit(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def check(html, chunk):
+    expected = parse_product_grid_soup(html)
+    limit = app.SEARCH_RESULT_LIMIT
+    results = {
+        'completo': (app.parse_product_grid(html), expected),
+        f'límite {limit}': (app.parse_product_grid(html, limit), expected[:limit]),
+        f'streaming {chunk}B': (app.parse_product_grid(chunked(html, chunk), limit), expected[:limit]),
+        # Pedazos mínimos para forzar cortes en medio de tags y entidades
+        'streaming 7B': (app.parse_product_grid(chunked(html, 7)), expected),
+    }
+    for name, (got, want) in results.items():
+        if got != want:
+            for a, b in zip(got, want):
+                if a != b:
+                    print(f"  difiere ({name}): {a} != {b}")
+                    break
+            raise SystemExit(f"  {name}: {len(got)} productos, se esperaban {len(want)} idénticos")
+    return len(expected)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('fixtures', nargs='*')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--chunk', type=int, default=app.SEARCH_PARSE_CHUNK)
+    args = parser.parse_args()
+
+    paths = args.fixtures or sorted(glob.glob(os.path.join(FIXTURES, '*.html')))
+    limit = app.SEARCH_RESULT_LIMIT
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        count = check(html, args.chunk)
+        print(f"{os.path.basename(path)}: {len(html) / 1024:.0f} KiB, {count} productos, salida idéntica")
+
+        soup = timeit(lambda: parse_product_grid_soup(html), args.repeat)
+        full = timeit(lambda: app.parse_product_grid(html), args.repeat)
+        limited = timeit(lambda: app.parse_product_grid(chunked(html, args.chunk), limit), args.repeat)
+        print(f"  BeautifulSoup          {soup * 1000:8.2f} ms")
+        print(f"  HTMLParser completo    {full * 1000:8.2f} ms  ({soup / full:.1f}x)")
+        print(f"  HTMLParser límite {limit}    {limited * 1000:8.2f} ms  ({soup / limited:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
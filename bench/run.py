@@ -0,0 +1,110 @@
+"""Levanta los servicios simulados y la app, y corre bench/load.py contra ellos.
+
+    python bench/run.py --server gunicorn -- --scenarios chat,search,webhook --concurrency 1,8,32
+    python bench/run.py --server uvicorn --openai-latency 0.5 -- --scenarios chat_stream
+
+Los argumentos después de `--` van a `load.py run`. La app usa la
+configuración de producción salvo por las URLs de los servicios externos, el
+índice del catálogo (desactivado, para medir la búsqueda en vivo) y el nivel de
+log. Sin DATABASE_URL la app no usa la base (el historial queda en la memoria
+de cada worker, como informa /readyz con not_configured); para incluir
+Postgres en la medición, exportar DATABASE_URL. El reporte registra cuál de los
+dos se usó y las latencias de los servicios simulados.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+
+SERVERS = {
+    'gunicorn': ['gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+    'uvicorn': ['uvicorn', 'asgi:application', '--host', '127.0.0.1', '--no-access-log'],
+}
+
+
+def wait_for(url, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise SystemExit(f"El proceso terminó antes de responder {url}")
+        try:
+            with urllib.request.urlopen(url, timeout=2) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.25)
+    raise SystemExit(f"{url} no respondió en {timeout}s")
+
+
+def main():
+    argv = sys.argv[1:]
+    load_args = []
+    if '--' in argv:
+        load_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=sorted(SERVERS), default='gunicorn')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--mock-port', type=int, default=8900)
+    parser.add_argument('--openai-latency', default='0.8')
+    parser.add_argument('--graph-latency', default='0.15')
+    parser.add_argument('--storefront-latency', default='0.3')
+    parser.add_argument('--ready-timeout', type=float, default=120)
+    args = parser.parse_args(argv)
+
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    target = f"http://127.0.0.1:{args.port}"
+    workdir = tempfile.mkdtemp(prefix='chatbot-bench-')
+    env = dict(
+        os.environ,
+        OPENAI_API_BASE=f"{mock_url}/v1",
+        OPENAI_API_KEY='bench',
+        WHATSAPP_API_URL=mock_url,
+        PHONE_NUMBER_ID='bench',
+        ACCESS_TOKEN='bench',
+        SURCANSA_BASE_URL=mock_url,
+        CATALOG_REFRESH_INTERVAL='0',
+        CATALOG_DB_PATH=os.path.join(workdir, 'catalog.db'),
+        WEBHOOK_QUEUE_PATH=os.path.join(workdir, 'webhook_queue.db'),
+        LOG_LEVEL=os.getenv('LOG_LEVEL', 'CRITICAL'),
+        PORT=str(args.port),
+        BENCH_SERVER=args.server,
+    )
+    server_command = SERVERS[args.server] + (['--port', str(args.port)] if args.server == 'uvicorn' else [])
+
+    processes = []
+    try:
+        processes.append(subprocess.Popen([
+            sys.executable, os.path.join(BENCH_DIR, 'mock_services.py'), '--port', str(args.mock_port),
+            '--openai-latency', args.openai_latency, '--graph-latency', args.graph_latency,
+            '--storefront-latency', args.storefront_latency,
+        ], cwd=ROOT))
+        wait_for(f"{mock_url}/_stats", 30, processes[-1])
+
+        processes.append(subprocess.Popen(server_command, cwd=ROOT, env=env))
+        # /readyz espera al modelo de spaCy, así no se mide el calentamiento
+        wait_for(f"{target}/readyz", args.ready_timeout, processes[-1])
+
+        return subprocess.call(
+            [sys.executable, os.path.join(BENCH_DIR, 'load.py'), 'run', '--target', target, '--mock', mock_url] + load_args,
+            cwd=ROOT, env=env,
+        )
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""Micro-benchmark del armado de los mensajes de WhatsApp.
+
+Compara el camino anterior (carrusel de format_search_results, diccionario de
+la lista y json= de requests) contra WhatsAppPayloads con orjson y con json de
+la biblioteca estándar, en frío (lista nueva) y con la lista ya en caché, y
+verifica que el JSON enviado sea el mismo.
+
+    python bench/whatsapp_payload.py [--repeat 2000] [--products 10] [fixture.html]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault('APP_WARMUP', 'lazy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TO = '5493764000000'
+
+
+def carousel_payload(product_name, productos):
+    # Implementación anterior, se conserva como referencia
+    products = app.format_search_results(product_name, productos)['carousel']
+    elements = [
+        {
+            "title": product['title'],
+            "default_action": {
+                "type": "web_url",
+                "url": product['default_action']['url'],
+                "webview_height_ratio": "tall",
+            },
+            "buttons": [
+                {
+                    "type": "web_url",
+                    "url": product['default_action']['url'],
+                    "title": "Ver Producto"
+                }
+            ]
+        }
+        for product in products
+    ]
+    data = {
+        "messaging_product": "whatsapp",
+        "to": TO,
+        "type": "interactive",
+        "interactive": {
+            "type": "list",
+            "header": {"type": "text", "text": "Productos Disponibles"},
+            "body": {"text": "Selecciona un producto para obtener más información."},
+            "action": {
+                "button": "Ver Productos",
+                "sections": [{"title": "Productos", "rows": elements}]
+            }
+        }
+    }
+    # Lo mismo que hace requests con json=
+    return json.dumps(data, allow_nan=False).encode('utf-8')
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def builders():
+    encoders = {'json': stdlib_dumps}
+    if app.orjson is not None:
+        encoders['orjson'] = app.orjson.dumps
+    return {name: app.WhatsAppPayloads(1024, dumps) for name, dumps in encoders.items()}
+
+
+def render(payloads, productos, cached):
+    # Mismo camino que whatsapp_product_list + send_whatsapp_list
+    if not cached:
+        payloads._rendered.clear()
+    rows = tuple((producto['titulo'], producto['link']) for producto in productos)
+    return payloads.interactive_message(TO, payloads.product_list(rows))
+
+
+def timeit(func, repeat):
+    best = float('inf')
+    for _ in range(5):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        best = min(best, (time.perf_counter() - started) / repeat)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('fixture', nargs='?', default=sorted(glob.glob(os.path.join(FIXTURES, 'search-*.html')))[0])
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--products', type=int, default=app.SEARCH_RESULT_LIMIT)
+    args = parser.parse_args()
+
+    with open(args.fixture, encoding='utf-8') as f:
+        productos = app.parse_product_grid(f.read(), args.products)
+    product_name = os.path.splitext(os.path.basename(args.fixture))[0].split('-', 1)[-1]
+
+    expected = carousel_payload(product_name, productos)
+    candidates = builders()
+    for name, payloads in candidates.items():
+        for cached in (False, True):
+            got = render(payloads, productos, cached)
+            if json.loads(got) != json.loads(expected):
+                raise SystemExit(f"{name}: el JSON difiere del anterior")
+    print(f"{len(productos)} productos, {len(expected)} bytes antes, "
+          f"{len(render(next(iter(candidates.values())), productos, True))} bytes ahora (UTF-8 sin escapes), "
+          f"mismo JSON")
+
+    base = timeit(lambda: carousel_payload(product_name, productos), args.repeat)
+    print(f"  carrusel + dict + json     {base * 1e6:8.1f} µs")
+    for name, payloads in candidates.items():
+        cold = timeit(lambda: render(payloads, productos, False), args.repeat)
+        warm = timeit(lambda: render(payloads, productos, True), args.repeat)
+        print(f"  {name:7s} sin caché          {cold * 1e6:8.1f} µs  ({base / cold:.1f}x)")
+        print(f"  {name:7s} lista en caché     {warm * 1e6:8.1f} µs  ({base / warm:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# Configuración de gunicorn: gunicorn -c gunicorn.conf.py app:app
+# Con preload_app el modelo de spaCy se carga una sola vez en el proceso
+# maestro y los workers lo comparten copy-on-write después del fork, en lugar
+# de que cada worker cargue su propia copia al arrancar.
+import gc
+import os
+import time
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '60'))
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+if preload_app:
+    # El maestro carga el modelo al importar la app; la base se abre en cada worker
+    os.environ.setdefault('APP_WARMUP', 'preload')
+    # Las migraciones corren una vez en el maestro antes de levantar los
+    # workers, en lugar de en el primer uso de la base de cada worker
+    os.environ.setdefault('SCHEMA_MIGRATIONS_ON', 'master')
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import app
+    server.log.info("Perfil de arranque del maestro (pid %s): %s", os.getpid(), dict(app.STARTUP_PROFILE))
+    if app.SCHEMA_MIGRATIONS_ON == 'master' and app.DATABASE_URL:
+        started = time.monotonic()
+        try:
+            app.run_migrations()
+        except Exception:
+            server.log.exception("Error aplicando las migraciones")
+        else:
+            server.log.info("Migraciones aplicadas en %.2fs", time.monotonic() - started)
+
+
+def pre_fork(server, worker):
+    # Mover los objetos ya creados a la generación permanente: así el GC de los
+    # workers no los recorre ni escribe en sus páginas (lo que rompería el COW).
+    gc.freeze()
+    worker.fork_started = time.monotonic()
+
+
+def post_worker_init(worker):
+    import app
+    # Calentar lo que falte en este worker (pool de la base) sin bloquear el arranque
+    app.start_warm_up()
+    worker.log.info(
+        "Worker %s listo en %.2fs (modelo %s)",
+        worker.pid, time.monotonic() - worker.fork_started,
+        "compartido del maestro" if app.NLP_LOADED_IN_PID not in (None, os.getpid()) else "cargado en el worker",
+    )
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# La app se importa sin calentar el modelo ni la base
+os.environ.setdefault('APP_WARMUP', 'lazy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(app.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Cliente de Flask sin hilos de fondo ni servicios externos
+    monkeypatch.setattr(app, 'start_catalog_refresher', lambda: None)
+    monkeypatch.setattr(app.conversation_sweeper, 'start', lambda: None)
+    monkeypatch.setattr(app.webhook_dispatcher, 'start', lambda: None)
+    return app.app.test_client()
@@ -0,0 +1,139 @@
+import pytest
+import requests
+
+import app
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    # Devuelve (o lanza) los resultados en orden
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state() == 'open'
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = app.CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state() == 'closed'
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state() == 'open'
+    assert not breaker.allow()
+
+
+def test_half_open_allows_a_single_probe(clock):
+    breaker = app.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.state() == 'half_open'
+    assert not breaker.allow()
+
+
+def test_successful_probe_closes(clock):
+    breaker = app.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state() == 'closed'
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = app.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state() == 'open'
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+
+
+def test_released_probe_lets_the_next_call_probe(clock):
+    breaker = app.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state() == 'open'
+    assert breaker.allow()
+    assert breaker.state() == 'half_open'
+
+
+def client_with(monkeypatch, *outcomes):
+    client = app.UpstreamClient('test')
+    session = FakeSession(*outcomes)
+    monkeypatch.setattr(client, 'session', lambda: session)
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+    return client, session
+
+
+@pytest.mark.parametrize('error', [
+    requests.exceptions.ChunkedEncodingError('cuerpo cortado'),
+    requests.exceptions.ContentDecodingError('gzip inválido'),
+    requests.exceptions.InvalidURL('url inválida'),
+])
+def test_unexpected_error_in_probe_reopens(clock, monkeypatch, error):
+    client, session = client_with(monkeypatch, error, 200)
+    open_breaker(client.breaker)
+    clock.now += app.CIRCUIT_RESET_TIMEOUT
+
+    with pytest.raises(type(error)):
+        client.get('http://tienda/search', 'search')
+    assert session.calls == 1
+    assert client.breaker.state() == 'open'
+
+    clock.now += app.CIRCUIT_RESET_TIMEOUT
+    assert client.get('http://tienda/search', 'search').status_code == 200
+    assert client.breaker.state() == 'closed'
+
+
+def test_interrupted_probe_is_released(clock, monkeypatch):
+    client, session = client_with(monkeypatch, KeyboardInterrupt(), 200)
+    open_breaker(client.breaker)
+    clock.now += app.CIRCUIT_RESET_TIMEOUT
+
+    with pytest.raises(KeyboardInterrupt):
+        client.get('http://tienda/search', 'search')
+    assert client.breaker.state() == 'open'
+    assert client.get('http://tienda/search', 'search').status_code == 200
+    assert client.breaker.state() == 'closed'
+
+
+def test_server_errors_count_as_failures(clock, monkeypatch):
+    client, session = client_with(monkeypatch, *[503] * (app.HTTP_MAX_RETRIES + 1))
+    assert client.get('http://tienda/search', 'search').status_code == 503
+    assert session.calls == app.HTTP_MAX_RETRIES + 1
+    assert client.breaker.failures == app.HTTP_MAX_RETRIES + 1
@@ -0,0 +1,91 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app
+
+
+class FakeSummarizer:
+    # chat_completion que espera a que el test lo libere
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def __call__(self, prompt, **kwargs):
+        self.calls.append(prompt[-1]['content'])
+        self.release.wait(5)
+        message = {'content': f"resumen {len(self.calls)}"}
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    summarizer = FakeSummarizer()
+    monkeypatch.setattr(app, 'chat_completion', summarizer)
+    monkeypatch.setattr(app, 'system_prompt_message', lambda: ({'role': 'system', 'content': 'prompt'}, 10))
+    monkeypatch.setattr(app, 'count_message_tokens', lambda message: 10)
+    return summarizer
+
+
+@pytest.fixture
+def window():
+    # Entran 4 mensajes recientes: 10 + 10 + 20 (resumen) + 3 + 4 * 10 <= 83
+    return app.ContextWindow(budget=83, summary_max_tokens=20, cache_size=10, batch_messages=4)
+
+
+def history(count):
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"mensaje {i}"} for i in range(count)]
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def summary_of(messages):
+    return [m['content'] for m in messages if m['content'].startswith('Resumen de la conversación')]
+
+
+def test_build_does_not_wait_for_the_summary(window, summarizer):
+    messages = window.build('web:u', history(6), 'hola')
+    # Sin resumen todavía: se programa pero la respuesta no lo espera
+    assert summary_of(messages) == []
+    assert len(messages) == 6
+    summarizer.release.set()
+    wait_for(lambda: window.snapshot()['cached_summaries'] == 1)
+    assert summary_of(window.build('web:u', history(6), 'hola')) == ['Resumen de la conversación previa: resumen 1']
+
+
+def test_summary_is_refreshed_once_a_batch_builds_up(window, summarizer):
+    summarizer.release.set()
+    window.build('web:u', history(6), 'hola')
+    wait_for(lambda: window.snapshot()['summaries'] == 1)
+    # Dos mensajes nuevos fuera de la ventana no alcanzan para otro resumen
+    window.build('web:u', history(8), 'hola')
+    assert window.snapshot()['summaries_scheduled'] == 1
+    # Con 4 se pliegan en un solo resumen
+    window.build('web:u', history(10), 'hola')
+    wait_for(lambda: window.snapshot()['summaries'] == 2)
+    assert 'mensaje 2' in summarizer.calls[-1] and 'mensaje 5' in summarizer.calls[-1]
+    assert 'mensaje 1' not in summarizer.calls[-1]
+
+
+def test_reset_forgets_the_summary(window, summarizer):
+    summarizer.release.set()
+    window.build('web:u', history(6), 'hola')
+    wait_for(lambda: window.snapshot()['cached_summaries'] == 1)
+    window.reset('web:u')
+    assert summary_of(window.build('web:u', history(6), 'hola')) == []
+
+
+def test_summary_in_progress_is_dropped_on_reset(window, summarizer):
+    window.build('web:u', history(6), 'hola')
+    wait_for(lambda: summarizer.calls)
+    window.reset('web:u')
+    summarizer.release.set()
+    wait_for(lambda: window.snapshot()['summaries'] == 1)
+    assert window.snapshot()['cached_summaries'] == 0
@@ -0,0 +1,64 @@
+import uuid
+
+import pytest
+
+import app
+
+PHONE = '5493764000000'
+
+
+@pytest.fixture
+def turns(monkeypatch):
+    turns = []
+
+    def process_user_input(user_id, user_input, render_products=None):
+        turns.append(user_id)
+        return {'response': 'ok'}
+
+    monkeypatch.setattr(app, 'process_user_input', process_user_input)
+    return turns
+
+
+def new_cookie(response):
+    for header in response.headers.getlist('Set-Cookie'):
+        name, value = header.split(';')[0].split('=', 1)
+        if name == 'user_id':
+            return value
+
+
+def test_phone_number_cookie_gets_a_new_web_id(client, turns):
+    client.set_cookie('user_id', PHONE)
+    response = client.post('/chat', json={'input': 'hola'})
+    assert response.status_code == 200
+    user_id = new_cookie(response)
+    assert user_id != PHONE and str(uuid.UUID(user_id)) == user_id
+    assert turns == [f'web:{user_id}']
+
+
+def test_uuid_cookie_is_kept(client, turns):
+    user_id = str(uuid.uuid4())
+    client.set_cookie('user_id', user_id)
+    client.post('/chat', json={'input': 'hola'})
+    assert turns == [f'web:{user_id}']
+
+
+def test_reset_only_touches_web_history(client, monkeypatch):
+    reset = []
+    monkeypatch.setattr(app.conversation_store, 'reset', reset.append)
+    client.set_cookie('user_id', PHONE)
+    client.post('/reset')
+    assert len(reset) == 1 and reset[0].startswith('web:') and PHONE not in reset[0]
+
+
+def test_whatsapp_history_is_keyed_by_channel(turns, monkeypatch):
+    monkeypatch.setattr(app, 'send_whatsapp_message', lambda to, text: None)
+    app.handle_whatsapp_message({'from': PHONE, 'text': 'hola'})
+    assert turns == [f'wa:{PHONE}']
+
+
+def test_asgi_rejects_non_uuid_cookie():
+    asgi = pytest.importorskip('asgi')
+    user_id, headers = asgi._user_id({'cookie': f'user_id={PHONE}'})
+    assert user_id != PHONE and headers
+    valid = str(uuid.uuid4())
+    assert asgi._user_id({'cookie': f'user_id={valid}'}) == (valid, [])
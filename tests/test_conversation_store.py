@@ -0,0 +1,103 @@
+import contextlib
+
+import pytest
+
+import app
+
+
+class FakeMessages:
+    # Tabla messages compartida por varios "workers"
+    def __init__(self):
+        self.rows = []
+        self.queries = 0
+
+    def insert(self, user_id, role, content):
+        message_id = len(self.rows) + 1
+        self.rows.append((message_id, user_id, role, content))
+        return message_id
+
+    @contextlib.contextmanager
+    def transaction(self):
+        yield FakeCursor(self)
+
+
+class FakeCursor:
+    def __init__(self, table):
+        self.table = table
+        self.result = None
+
+    def execute(self, sql, params):
+        self.table.queries += 1
+        if sql.lstrip().startswith('INSERT'):
+            self.result = [(self.table.insert(*params),)]
+        elif 'id > %s' in sql:
+            user_id, last_id = params
+            self.result = [(i, role, content) for i, u, role, content in self.table.rows if u == user_id and i > last_id]
+        else:
+            user_id, limit = params
+            rows = [(i, role, content) for i, u, role, content in self.table.rows if u == user_id]
+            self.result = rows[-limit:]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeMessages()
+    monkeypatch.setattr(app, 'db_transaction', table.transaction)
+    return table
+
+
+def contents(messages):
+    return [message['content'] for message in messages]
+
+
+def test_reads_rows_written_by_another_worker(table):
+    worker_a = app.ConversationStore(max_messages=10, cache_size=10)
+    worker_b = app.ConversationStore(max_messages=10, cache_size=10)
+    assert worker_a.history('u') == []
+    worker_a.append('u', 'user', 'hola')
+
+    # Otro worker inserta antes de que este guarde su respuesta
+    worker_b.append('u', 'user', 'precio del cemento')
+    worker_a.append('u', 'assistant', '¡Hola!')
+
+    assert contents(worker_a.history('u')) == ['hola', 'precio del cemento', '¡Hola!']
+    assert worker_a.snapshot()['rows_from_db'] == 1
+
+
+def test_own_messages_are_not_duplicated(table):
+    store = app.ConversationStore(max_messages=10, cache_size=10)
+    store.history('u')
+    store.append('u', 'user', 'hola')
+    store.append('u', 'assistant', '¡Hola!')
+    assert contents(store.history('u')) == ['hola', '¡Hola!']
+    assert contents(store.history('u')) == ['hola', '¡Hola!']
+    stats = store.snapshot()
+    assert stats['full_reads'] == 1
+    assert stats['incremental_reads'] == 2
+    assert stats['rows_from_db'] == 0
+
+
+def test_keeps_only_the_latest_messages(table):
+    store = app.ConversationStore(max_messages=2, cache_size=10)
+    store.history('u')
+    for text in ('uno', 'dos', 'tres'):
+        store.append('u', 'user', text)
+    assert contents(store.history('u')) == ['dos', 'tres']
+
+
+def test_without_database_history_stays_in_memory(monkeypatch):
+    monkeypatch.setattr(app, 'db_transaction', None)
+    store = app.ConversationStore(max_messages=10, cache_size=10, persistent=False)
+    assert store.history('u') == []
+    store.append('u', 'user', 'hola')
+    store.append('u', 'assistant', '¡Hola!')
+    assert contents(store.history('u')) == ['hola', '¡Hola!']
+    store.reset('u')
+    assert store.history('u') == []
+    assert store.snapshot()['db_errors'] == 0
@@ -0,0 +1,17 @@
+import app
+
+
+def test_counts_without_database(client, monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE_URL', None)
+    aggregator = app.CountsAggregator(interval=60, max_events=100)
+    monkeypatch.setattr(aggregator, '_ensure_started', lambda: None)
+    monkeypatch.setattr(app, 'counts_aggregator', aggregator)
+    aggregator.increment()
+    aggregator.increment()
+    aggregator.flush()
+
+    response = client.get('/counts')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body['daily'], body['monthly'], body['persisted']) == (2, 2, False)
+    assert aggregator.stats['flush_errors'] == 0
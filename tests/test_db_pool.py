@@ -0,0 +1,58 @@
+import threading
+
+import pytest
+
+import app
+
+
+class FakePool:
+    def __init__(self, minconn, maxconn, timeout):
+        self.closed = False
+
+    def closeall(self):
+        self.closed = True
+
+
+def test_pool_is_published_after_migrations(monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE_URL', 'postgresql://bench@localhost/chatbot')
+    monkeypatch.setattr(app, 'DatabasePool', FakePool)
+    monkeypatch.setattr(app, '_db_pool', None)
+    monkeypatch.setattr(app, 'SCHEMA_MIGRATIONS_ON', 'worker')
+    migrating = threading.Event()
+    finish = threading.Event()
+    seen = []
+
+    def migrate(pool):
+        migrating.set()
+        finish.wait(5)
+
+    monkeypatch.setattr(app, 'migrate_schema', migrate)
+    worker = threading.Thread(target=lambda: seen.append(app.get_db_pool()))
+    worker.start()
+    assert migrating.wait(5)
+    # Mientras migra, el pool todavía no está publicado para otros hilos
+    assert app.db_pool_stats()['initialized'] is False
+    finish.set()
+    worker.join(5)
+    assert app._db_pool is seen[0]
+
+
+def test_workers_skip_migrations_when_the_master_runs_them(monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE_URL', 'postgresql://bench@localhost/chatbot')
+    monkeypatch.setattr(app, 'DatabasePool', FakePool)
+    monkeypatch.setattr(app, '_db_pool', None)
+    monkeypatch.setattr(app, 'SCHEMA_MIGRATIONS_ON', 'master')
+    calls = []
+    monkeypatch.setattr(app, 'migrate_schema', calls.append)
+    app.get_db_pool()
+    assert calls == []
+
+    app.run_migrations()
+    assert len(calls) == 1 and calls[0].closed
+
+
+def test_unconfigured_database_fails_fast(monkeypatch):
+    monkeypatch.setattr(app, 'DATABASE_URL', None)
+    monkeypatch.setattr(app, 'DatabasePool', None)
+    with pytest.raises(app.DatabaseNotConfigured):
+        app.get_db_pool()
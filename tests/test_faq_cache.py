@@ -0,0 +1,76 @@
+import numpy
+import pytest
+
+import app
+
+VECTORS = {
+    'horario': [1.0, 0.0, 0.0],
+    'a qué hora abren': [0.99, 0.14, 0.0],
+    'envíos': [0.0, 1.0, 0.0],
+    'formas de pago': [0.0, 0.0, 1.0],
+    'mi pedido 1234': [0.0, 0.0, 1.0],
+    'hacen envíos los sábados': [0.0, 0.7, 0.7],
+    'no hacen envíos los sábados': [0.0, 0.7, 0.7],
+}
+
+
+@pytest.fixture(autouse=True)
+def fake_analysis(monkeypatch):
+    monkeypatch.setattr(app, 'question_vector', lambda text: numpy.array(VECTORS[text]) / numpy.linalg.norm(VECTORS[text]))
+    monkeypatch.setattr(app, 'is_personal_question', lambda text: any(c.isdigit() for c in text) or 'mi ' in text)
+    monkeypatch.setattr(app, 'question_qualifiers', lambda text: frozenset(text.split()) & app.QUESTION_QUALIFIERS)
+
+
+def test_similar_question_hits(clock):
+    cache = app.SemanticAnswerCache(threshold=0.95, ttl=60, maxsize=4)
+    cache.store('horario', 'De 8 a 18')
+    assert cache.lookup('a qué hora abren') == 'De 8 a 18'
+    assert cache.lookup('envíos') is None
+    assert cache.snapshot()['hits'] == 1
+
+
+def test_negated_question_does_not_hit(clock):
+    cache = app.SemanticAnswerCache(threshold=0.95, ttl=60, maxsize=4)
+    cache.store('hacen envíos los sábados', 'Sí, los sábados también')
+    assert cache.lookup('no hacen envíos los sábados') is None
+    cache.store('no hacen envíos los sábados', 'Sí, los sábados también hacemos envíos')
+    assert cache.lookup('hacen envíos los sábados') == 'Sí, los sábados también'
+    assert cache.lookup('no hacen envíos los sábados') == 'Sí, los sábados también hacemos envíos'
+
+
+def test_personal_questions_are_not_stored(clock):
+    cache = app.SemanticAnswerCache(threshold=0.95, ttl=60, maxsize=4)
+    cache.store('mi pedido 1234', 'Tu pedido sale mañana')
+    assert cache.lookup('formas de pago') is None
+    assert cache.snapshot()['skipped_personal'] == 1
+    assert cache.snapshot()['size'] == 0
+
+
+def test_evicts_least_recently_used_row(clock):
+    cache = app.SemanticAnswerCache(threshold=0.95, ttl=60, maxsize=2)
+    cache.store('horario', 'De 8 a 18')
+    cache.store('envíos', 'A todo el país')
+    assert cache.lookup('horario') == 'De 8 a 18'
+    cache.store('formas de pago', 'Efectivo o tarjeta')
+    assert cache.lookup('envíos') is None
+    assert cache.lookup('horario') == 'De 8 a 18'
+    assert cache.lookup('formas de pago') == 'Efectivo o tarjeta'
+    assert cache.snapshot()['evictions'] == 1
+
+
+def test_expired_rows_are_reused(clock):
+    cache = app.SemanticAnswerCache(threshold=0.95, ttl=60, maxsize=1)
+    cache.store('horario', 'De 8 a 18')
+    clock.now += 61
+    assert cache.lookup('horario') is None
+    assert cache.snapshot()['expired'] == 1
+    cache.store('envíos', 'A todo el país')
+    assert cache.lookup('envíos') == 'A todo el país'
+    assert cache.snapshot()['evictions'] == 0
+
+
+def test_no_lookup_with_history(clock, monkeypatch):
+    monkeypatch.setattr(app, 'faq_cache', app.SemanticAnswerCache(threshold=0.95, ttl=60, maxsize=4))
+    app.faq_cache.store('horario', 'De 8 a 18')
+    assert app.cached_reply('horario', []) == 'De 8 a 18'
+    assert app.cached_reply('horario', [{'role': 'user', 'content': 'hola'}]) is None
@@ -0,0 +1,22 @@
+def metric_types(client):
+    body = client.get('/metrics').get_data(as_text=True)
+    return dict(line.split()[2:4] for line in body.splitlines() if line.startswith('# TYPE'))
+
+
+def test_ids_and_config_are_not_exported(client):
+    types = metric_types(client)
+    for name in ('chatbot_nlp_model_pid', 'chatbot_nlp_model_loaded_in_pid', 'chatbot_db_pool_max_size',
+                 'chatbot_context_window_budget', 'chatbot_faq_cache_threshold', 'chatbot_webhook_workers'):
+        assert not any(metric.startswith(name) for metric in types), name
+
+
+def test_counters_and_gauges(client):
+    types = metric_types(client)
+    assert types['chatbot_search_cache_hits_total'] == 'counter'
+    assert types['chatbot_openai_latency_seconds_total'] == 'counter'
+    assert types['chatbot_http_storefront_requests_total'] == 'counter'
+    assert types['chatbot_search_cache_size'] == 'gauge'
+    assert types['chatbot_faq_cache_hit_rate'] == 'gauge'
+    assert types['chatbot_openai_latency_seconds_max'] == 'gauge'
+    assert 'chatbot_search_cache_hits' not in types
+
@@ -0,0 +1,137 @@
+import multiprocessing
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def store(tmp_path):
+    return app.SharedFlightStore(str(tmp_path / 'flights.db'), wait=5, result_ttl=10)
+
+
+def in_child(target, *args):
+    # Otro worker: un proceso hijo con su propio descriptor del archivo de locks
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=lambda: results.put(target(*args)))
+    process.start()
+    result = results.get(timeout=10)
+    process.join(10)
+    return result
+
+
+def run_concurrently(count, fn):
+    threads = [threading.Thread(target=fn) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = app.SingleFlight('test')
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return ['cemento']
+
+    threads = run_concurrently(4, lambda: results.append(flight.do('cemento', fetch)))
+    while flight.snapshot()['coalesced'] < 3:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == [1]
+    assert results == [['cemento']] * 4
+    stats = flight.snapshot()
+    assert (stats['calls'], stats['executions'], stats['coalesced'], stats['in_flight']) == (4, 1, 3, 0)
+
+
+def test_waiters_get_the_leaders_error():
+    flight = app.SingleFlight('test')
+    release = threading.Event()
+    errors = []
+
+    def fetch():
+        release.wait(5)
+        raise ValueError('tienda caída')
+
+    def call():
+        try:
+            flight.do('cemento', fetch)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = run_concurrently(3, call)
+    while flight.snapshot()['coalesced'] < 2:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert errors == ['tienda caída'] * 3
+    assert flight.snapshot()['errors'] == 1
+
+
+def test_key_is_held_once_per_process(store):
+    assert store.acquire('search:cemento') is True
+    # Otro hilo o corrutina del mismo proceso no la toma aunque lockf lo permitiría
+    assert store.acquire('search:cemento') is False
+    assert in_child(store.acquire, 'search:cemento') is False
+    store.release('search:cemento')
+    assert in_child(store.acquire, 'search:cemento') is True
+    assert store.acquire('search:cemento') is True
+
+
+def test_result_from_another_worker_is_shared(store, tmp_path):
+    other = app.SharedFlightStore(store.path, wait=5, result_ttl=10)
+    assert other.run('search:cemento', lambda: ['cemento']) == (['cemento'], 'executions')
+    assert store.run('search:cemento', lambda: pytest.fail('no debería llamarse')) == (['cemento'], 'shared')
+
+
+def test_gives_up_waiting_for_another_worker(store):
+    store.wait = 0.1
+    context = multiprocessing.get_context('fork')
+    holding, done = context.Event(), context.Event()
+
+    def hold():
+        store.acquire('faq:horario')
+        holding.set()
+        done.wait(10)
+
+    process = context.Process(target=hold)
+    process.start()
+    try:
+        assert holding.wait(10)
+        assert store.run('faq:horario', lambda: 'De 8 a 18') == ('De 8 a 18', 'shared_timeouts')
+    finally:
+        done.set()
+        process.join(10)
+
+
+def test_sync_and_async_flights_coordinate(store, monkeypatch):
+    asgi = pytest.importorskip('asgi')
+    import asyncio
+    monkeypatch.setattr(app.search_flight, 'shared', store)
+    assert store.acquire('search:cemento') is True
+
+    async def fetch():
+        return ['cemento']
+
+    async def main():
+        task = asyncio.ensure_future(asgi.AsyncSingleFlight(app.search_flight).do('cemento', fetch))
+        await asyncio.sleep(0.2)
+        # El hilo que tiene la clave todavía no terminó: la corrutina espera
+        assert not task.done()
+        await asyncio.get_running_loop().run_in_executor(None, store.store, 'search:cemento', ['desde el hilo'])
+        return await task
+
+    try:
+        assert asyncio.run(main()) == ['desde el hilo']
+    finally:
+        store.release('search:cemento')
+        asyncio.run(asgi.runtime.stop())
@@ -0,0 +1,71 @@
+import multiprocessing
+import queue
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'webhook_queue.db')
+
+
+def workers(path, maxsize=10):
+    # Dos workers de gunicorn sobre el mismo archivo
+    return app.WebhookQueue(path, maxsize, dedup_ttl=60), app.WebhookQueue(path, maxsize, dedup_ttl=60)
+
+
+def job(message_id, phone='5493764000001', text='hola'):
+    return {'id': message_id, 'from': phone, 'text': text}
+
+
+def rows(store):
+    conn = store._conn()
+    return (conn.execute('SELECT count(*) FROM webhook_messages').fetchone()[0],
+            conn.execute('SELECT count(*) FROM webhook_jobs').fetchone()[0])
+
+
+def test_duplicate_is_dropped_across_workers(path):
+    first, second = workers(path)
+    assert first.enqueue([job('wamid.1')]) == [job('wamid.1')]
+    assert second.enqueue([job('wamid.1'), job('wamid.2')]) == [job('wamid.2')]
+    assert rows(first) == (2, 2)
+
+
+def test_phone_messages_are_claimed_in_order(path):
+    first, second = workers(path)
+    first.enqueue([job('wamid.1', text='uno'), job('wamid.2', text='dos'),
+                   job('wamid.3', phone='5493764000002', text='otro')])
+    claimed = first.claim()
+    assert claimed['text'] == 'uno'
+    # El segundo mensaje del mismo número espera aunque lo pida otro worker
+    other = second.claim()
+    assert other['text'] == 'otro'
+    assert second.claim() is None
+    first.complete(claimed['seq'])
+    assert second.claim()['text'] == 'dos'
+
+
+def test_full_queue_rolls_back_the_whole_delivery(path):
+    first, second = workers(path, maxsize=2)
+    with pytest.raises(queue.Full):
+        second.enqueue([job('wamid.1'), job('wamid.2'), job('wamid.3')])
+    assert rows(first) == (0, 0)
+    # Los IDs no quedaron marcados: el reintento de Meta se acepta
+    assert len(first.enqueue([job('wamid.1'), job('wamid.2')])) == 2
+
+
+def claim_and_exit(path):
+    app.WebhookQueue(path, 10, dedup_ttl=60).claim()
+
+
+def test_orphans_of_dead_workers_are_released(path):
+    first, _ = workers(path)
+    first.enqueue([job('wamid.1')])
+    process = multiprocessing.get_context('fork').Process(target=claim_and_exit, args=(path,))
+    process.start()
+    process.join(10)
+    assert first.claim() is None
+    assert first.release_orphans() == 1
+    assert first.claim()['id'] == 'wamid.1'